@@ -23,6 +23,18 @@ class Defaults:
     DAVATAR_SERVER = 'http://davatar.seveas.net/avatar'
     MAX_SEARCH_DEPTH = 2
     CACHE_ROOT     = '/tmp/goblet-snapshots'
+    SNAPSHOT_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+    RENDER_CACHE_SIZE = 256 * 1024 * 1024
+    REPO_POOL_SIZE = 20
+    CACHE_REPO_SIZE = 64 * 1024 * 1024
+    CACHE_TOTAL_SIZE = 1024 * 1024 * 1024
+    CACHE_EVICT_INTERVAL = 300
+    WARM_SNAPSHOT_FORMATS = []
+    TRIGRAM_INDEX = False
+    TRIGRAM_INDEX_TAGS = 3
+    SEARCH_WORKERS = 4
+    SEARCH_TIMEOUT = 10
+    CACHE_MAX_AGE = 60
     USE_X_SENDFILE = False
     USE_X_ACCEL_REDIRECT = False
     ADMINS         = []
@@ -79,9 +91,12 @@ def inject_functions():
 
 # URL structure
 app.add_url_rule('/', view_func=v.IndexView.as_view('index'))
+app.add_url_rule('/search/', view_func=v.SearchView.as_view('search'))
 app.add_url_rule('/<path:repo>/', view_func=v.RepoView.as_view('repo'))
 app.add_url_rule('/<repo>/tree/<path:path>/', view_func=v.TreeView.as_view('tree'))
 app.add_url_rule('/j/<path:repo>/treechanged/<path:path>/', view_func=j.TreeChangedView.as_view('treechanged'))
+app.add_url_rule('/j/<path:repo>/blobwindow/<path:path>', view_func=j.BlobWindowView.as_view('blobwindow'))
+app.add_url_rule('/j/<path:repo>/filediff/<ref>/<int:num>/', view_func=j.FileDiffView.as_view('filediff'))
 app.add_url_rule('/<path:repo>/history/<path:path>', view_func=v.HistoryView.as_view('history'))
 app.add_url_rule('/<path:repo>/blame/<path:path>', view_func=v.BlobView.as_view('blame'))
 app.add_url_rule('/<path:repo>/blob/<path:path>', view_func=v.BlobView.as_view('blob'))
@@ -113,5 +128,8 @@ if not app.debug and app.config['ADMINS']:
     app.logger.addHandler(mail_handler)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['warm']:
+        import goblet.warm
+        sys.exit(goblet.warm.main(sys.argv[2:]))
     os.chdir('/')
     app.run()
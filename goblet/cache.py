@@ -0,0 +1,180 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+from flask import current_app
+from goblet.index import utf8
+
+def atomic_write(path, data):
+    """Write data to path so readers never see a partial file. data can also
+       be an iterable of chunks, so big files needn't be in memory at once"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fd:
+            if isinstance(data, basestring):
+                data = [data]
+            for chunk in data:
+                fd.write(chunk)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def files(dirs, match=None):
+    """(last use, size, path) for all cached files in dirs, optionally only
+       the ones whose path matches"""
+    ret = []
+    for dir in dirs:
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            continue
+        for name in names:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(dir, name)
+            if match and not match(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ret.append((st.st_mtime, st.st_size, path))
+    return ret
+
+def evict(dirs, max_size, pinned=None, match=None):
+    """Remove the least recently used files in dirs until they use less than
+       max_size bytes together. Returns the number of removed files"""
+    entries = files(dirs, match)
+    size = sum([x[1] for x in entries])
+    if size <= max_size:
+        return 0
+    num = 0
+    for mtime, fsize, path in sorted(entries):
+        if pinned and pinned(path):
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        num += 1
+        size -= fsize
+        if size <= max_size * 0.9:
+            break
+    return num
+
+def due(stampfile, interval):
+    """Whether interval seconds have passed since we last did something,
+       marking it as done if so"""
+    try:
+        if os.stat(stampfile).st_mtime > time.time() - interval:
+            return False
+    except OSError:
+        pass
+    with open(stampfile, 'a'):
+        os.utime(stampfile, None)
+    return True
+
+class Cache(object):
+    """A directory of computed artifacts. Files are written atomically, only
+       one process computes a given key at a time and the least recently used
+       files are removed when the directory grows beyond max_size bytes. The
+       mtime of a file is its last use."""
+    def __init__(self, root, max_size=None, evict_interval=300):
+        self.root = root
+        self.max_size = max_size
+        self.evict_interval = evict_interval
+        self.hits = self.misses = self.evictions = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Path to the cached file for key, or None if it isn't cached"""
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, data):
+        atomic_write(self.path(key), data)
+        self.maybe_evict()
+        return self.path(key)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        # Keys hash into a fixed set of lockfiles, so they don't pile up
+        lockfile = os.path.join(self.root, '.lock-%s' % hashlib.md5(utf8(key)).hexdigest()[:2])
+        with open(lockfile, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def compute(self, key, function):
+        """Return the path to the cached file for key, calling function to
+           generate its contents if needed. Concurrent callers wait for the
+           first one instead of doing the same work"""
+        path = self.get(key)
+        if path:
+            self.hits += 1
+            return path
+        with self.lock(key):
+            path = self.get(key)
+            if path:
+                self.hits += 1
+                return path
+            self.misses += 1
+            return self.put(key, function())
+
+    def maybe_evict(self):
+        if self.max_size and due(os.path.join(self.root, '.evicted'), self.evict_interval):
+            self.evictions += evict([self.root], self.max_size)
+
+    def stats(self):
+        entries = files([self.root])
+        return {'files': len(entries), 'bytes': sum([x[1] for x in entries]),
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+def repo_cache(repo):
+    """The artifact cache of a repository, in <repo>/goblet/cache"""
+    if getattr(repo, '_cache', None) is None:
+        config = current_app.config
+        repo._cache = Cache(repo.cpath, config['CACHE_REPO_SIZE'], config['CACHE_EVICT_INTERVAL'])
+    cache = repo._cache
+    evict_repo_caches()
+    return cache
+
+def evict_repo_caches():
+    """Enforce CACHE_TOTAL_SIZE over the caches of all repositories"""
+    from goblet.catalog import get_catalog
+    config = current_app.config
+    if not config['CACHE_TOTAL_SIZE']:
+        return
+    if not os.path.exists(config['CACHE_ROOT']):
+        os.makedirs(config['CACHE_ROOT'])
+    if not due(os.path.join(config['CACHE_ROOT'], '.repo-caches-evicted'), config['CACHE_EVICT_INTERVAL']):
+        return
+    dirs = [os.path.join(entry['path'], 'goblet', 'cache') for entry in get_catalog().refresh()]
+    evict(dirs, config['CACHE_TOTAL_SIZE'])
+
+_render_cache = None
+def render_cache():
+    """Rendered blobs of all repositories, in CACHE_ROOT/render"""
+    global _render_cache
+    if _render_cache is None:
+        config = current_app.config
+        _render_cache = Cache(os.path.join(config['CACHE_ROOT'], 'render'), config['RENDER_CACHE_SIZE'], config['CACHE_EVICT_INTERVAL'])
+    return _render_cache
@@ -0,0 +1,120 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+import json
+import os
+import pygit2
+import threading
+from flask import current_app
+from goblet.monkey import refs_stamp
+from goblet.cache import atomic_write
+
+class Catalog(object):
+    """All repositories under REPO_ROOT with the data the index page needs.
+       Directory listings are reused until the directory's mtime changes and
+       repository data until its refs, description or config change. The
+       catalog is saved to disk, so restarted workers don't rebuild it."""
+    def __init__(self, root, depth, cache_file):
+        self.root = root
+        self.depth = depth
+        self.cache_file = cache_file
+        self.dirs = {}
+        self.repos = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file) as fd:
+                data = json.load(fd)
+            if data['root'] == self.root and data['depth'] == self.depth:
+                self.dirs, self.repos = data['dirs'], data['repos']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        if not self.dirty:
+            return
+        dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        atomic_write(self.cache_file, json.dumps({'root': self.root, 'depth': self.depth, 'dirs': self.dirs, 'repos': self.repos}))
+        self.dirty = False
+
+    def listing(self, root):
+        """Readable subdirectories of root, cached by the mtime of root"""
+        try:
+            mtime = os.stat(root).st_mtime
+        except OSError:
+            return []
+        self.seen.add(root)
+        if root in self.dirs and self.dirs[root][0] == mtime:
+            return self.dirs[root][1]
+        subdirs = []
+        for file in sorted(os.listdir(root)):
+            path = os.path.join(root, file)
+            if os.path.isdir(path) and os.access(path, os.R_OK):
+                subdirs.append(file)
+        self.dirs[root] = [mtime, subdirs]
+        self.dirty = True
+        return subdirs
+
+    def find(self, root, level):
+        for file in self.listing(root):
+            path = os.path.join(root, file)
+            if path.endswith('.git'):
+                yield path
+            elif os.path.exists(os.path.join(path, '.git')):
+                yield os.path.join(path, '.git')
+            elif level > 0:
+                for path in self.find(path, level-1):
+                    yield path
+
+    def entry(self, path):
+        stamp = list(refs_stamp(path, ('description', 'config')))
+        entry = self.repos.get(path, None)
+        if entry and entry['stamp'] == stamp:
+            return entry
+        try:
+            repo = pygit2.Repository(path)
+        except KeyError:
+            # Something was unreadable
+            return None
+        entry = {'path': path, 'stamp': stamp, 'name': repo.name, 'description': repo.description,
+                 'owner': repo.owner, 'clone_urls': repo.clone_urls, 'head': None}
+        if repo.head:
+            commit = repo[repo.head.target]
+            entry.update({'head': commit.hex, 'last_change': commit.commit_time,
+                          'author': commit.author.name, 'email': commit.author.email})
+        self.repos[path] = entry
+        self.dirty = True
+        return entry
+
+    def refresh(self):
+        """Bring the catalog up to date and return all entries, sorted by path"""
+        with self.lock:
+            self.seen = set()
+            repos = []
+            for path in sorted(self.find(self.root, self.depth), key=lambda x: x.lower()):
+                entry = self.entry(path)
+                if entry:
+                    repos.append(entry)
+            found = set([entry['path'] for entry in repos])
+            for path in [x for x in self.repos if x not in found]:
+                del self.repos[path]
+                self.dirty = True
+            for path in [x for x in self.dirs if x not in self.seen]:
+                del self.dirs[path]
+                self.dirty = True
+            self.save()
+            return repos
+
+_catalog = None
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        config = current_app.config
+        _catalog = Catalog(config['REPO_ROOT'], config['MAX_SEARCH_DEPTH'], os.path.join(config['CACHE_ROOT'], 'catalog.json'))
+    return _catalog
@@ -2,17 +2,58 @@
 # Copyright (C) 2012-2014 Dennis Kaarsemaker
 # See the LICENSE file for licensing details
 
+from goblet.memoize import memoize
 import chardet
 
+# chardet is slow, so it only sees this many bytes around the first byte that
+# isn't utf-8
+sample_size = 64 * 1024
+
+def is_binary(data):
+    """Like git: data with a NUL byte in the first 8000 bytes is binary"""
+    return '\0' in data[:8000]
+
+def detect(data):
+    """Guess the encoding of data. ASCII and utf-8 are recognized without
+       chardet, which otherwise only gets to look at a sample"""
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError, e:
+        # A sample may end in the middle of a character
+        if e.reason == 'unexpected end of data':
+            return 'utf-8'
+        start = max(0, e.start - sample_size // 2)
+    return chardet.detect(data[start:start + sample_size])['encoding']
+
+@memoize(maxsize=10000)
+def blob_encoding(repo, oid):
+    """Blobs never change, so their encoding is detected only once"""
+    return detect(repo[oid].data)
+
 def decode(data, encoding=None):
     if isinstance(data, unicode):
         return data
     if encoding:
         return data.decode(encoding)
+    # Fast path: ascii and utf-8
     try:
         return data.decode('utf-8')
     except UnicodeDecodeError:
-        encoding = chardet.detect(data)['encoding']
-        if not encoding:
-            return "(Binary data)"
-        return data.decode(encoding)
+        encoding = detect(data)
+    if not encoding:
+        return "(Binary data)"
+    # The sample may not be representative for all of the data
+    return data.decode(encoding, 'replace')
+
+def decode_blob(repo, oid, data=None):
+    """Decode the contents of a blob, with the encoding cached by oid"""
+    if data is None:
+        data = repo[oid].data
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        encoding = blob_encoding(repo, oid)
+    if not encoding:
+        return "(Binary data)"
+    return data.decode(encoding, 'replace')
@@ -8,6 +8,7 @@ from collections import defaultdict
 import hashlib
 from goblet.memoize import memoize
 from goblet.encoding import decode as decode_
+from goblet.index import trailer_re
 import stat
 import time
 import re
@@ -24,7 +25,7 @@ def filter(name_or_func):
     return decorator
 
 @filter('gravatar')
-@memoize
+@memoize(maxsize=10000)
 def gravatar(email, size=21):
     default = 'mm'
     if app.config['DAVATAR_SERVER'] and '@' in email:
@@ -82,7 +83,7 @@ def acks(message):
     if '\n' not in message:
         return []
     acks = defaultdict(list)
-    for ack, who in re.findall(r'^([-a-z]+(?:-[a-z]+)*):(.+?)(?:<.*)?\n', message.split('\n', 1)[1], flags=re.MULTILINE|re.I):
+    for ack, who in trailer_re.findall(message.split('\n', 1)[1]):
         ack = ack.lower().replace('-', ' ')
         ack = ack[0].upper() + ack[1:] # Can't use title
         acks[ack].append(who.strip())
@@ -0,0 +1,610 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+import hashlib
+import json
+import os
+import pygit2
+import re
+import sqlite3
+import stat
+import struct
+from collections import namedtuple
+from goblet.encoding import decode
+
+class Index(object):
+    """Base class for persistent per-repository indexes, stored as sqlite
+       databases in the goblet directory of the repository"""
+    name = None
+    schema = ""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo.gpath, '%s.sqlite' % self.name)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.schema)
+
+def utf8(name):
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+def changed_paths(repo, old, new, prefix=''):
+    """Paths of all files and directories that differ between two trees.
+       Either tree can be None, for added or removed directories"""
+    old = old and dict([(utf8(entry.name), entry) for entry in old]) or {}
+    new = new and dict([(utf8(entry.name), entry) for entry in new]) or {}
+    ret = []
+    for name in set(old) | set(new):
+        o, n = old.get(name, None), new.get(name, None)
+        if o and n and o.hex == n.hex and o.filemode == n.filemode:
+            continue
+        path = prefix + name
+        ret.append(path)
+        o = o and stat.S_ISDIR(o.filemode) and repo[o.oid] or None
+        n = n and stat.S_ISDIR(n.filemode) and repo[n.oid] or None
+        if o or n:
+            ret += changed_paths(repo, o, n, path + '/')
+    return ret
+
+class ChangedPathIndex(Index):
+    """Bloom filters of the paths each commit changed compared to its first
+       parent, like the changed-path filters in git's commit-graph. A negative
+       answer means the commit didn't touch the path, so history walks can
+       skip looking at its trees. Filters are computed the first time a commit
+       is asked about, and for new commits when the index is updated."""
+    name = 'changed_paths'
+    schema = "CREATE TABLE IF NOT EXISTS bloom (oid TEXT PRIMARY KEY, bits BLOB);"
+    bits_per_path = 10
+    hashes = 7
+    # Like git, don't bother with a filter for huge changes
+    max_paths = 512
+
+    def __init__(self, repo):
+        super(ChangedPathIndex, self).__init__(repo)
+        self.new = {}
+
+    def positions(self, path, size):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(utf8(path)).digest())
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def make_filter(self, commit):
+        parent = commit.parents and commit.parents[0].tree or None
+        paths = changed_paths(self.repo, parent, commit.tree)
+        if len(paths) > self.max_paths:
+            return None
+        size = max(64, len(paths) * self.bits_per_path)
+        size += -size % 8
+        bits = bytearray(size / 8)
+        for path in paths:
+            for pos in self.positions(path, size):
+                bits[pos / 8] |= 1 << (pos % 8)
+        return str(bits)
+
+    def get_filter(self, commit):
+        if commit.hex in self.new:
+            return self.new[commit.hex]
+        row = self.db.execute('SELECT bits FROM bloom WHERE oid=?', (commit.hex,)).fetchone()
+        if row:
+            return row[0] is not None and str(row[0]) or None
+        bits = self.new[commit.hex] = self.make_filter(commit)
+        return bits
+
+    def maybe_changed(self, commit, path):
+        """Whether commit may have changed path (file or directory) compared
+           to its first parent"""
+        bits = self.get_filter(commit)
+        if bits is None:
+            return True
+        bits = bytearray(bits)
+        for pos in self.positions(path, len(bits) * 8):
+            if not bits[pos / 8] & (1 << (pos % 8)):
+                return False
+        return True
+
+    def update(self, new, old=None):
+        """Compute filters for the commits in old..new"""
+        walker = self.repo.walk(new, pygit2.GIT_SORT_TOPOLOGICAL)
+        if old:
+            walker.hide(old)
+        for commit in walker:
+            self.get_filter(commit)
+            if len(self.new) > 1000:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        if not self.new:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO bloom (oid, bits) VALUES (?, ?)',
+                                [(oid, bits is not None and buffer(bits) or None) for oid, bits in self.new.items()])
+        self.new = {}
+
+Signature = namedtuple('Signature', ('name', 'email', 'time'))
+TagInfo = namedtuple('TagInfo', ('message', 'tagger'))
+CommitInfo = namedtuple('CommitInfo', ('hex', 'message'))
+
+class TagIndex(Index):
+    """All tags with their peeled commit, sort time, tagger and messages, so
+       the tags page can be paged and searched without looking at every tag
+       object. Tags are compared with the refs once per repository handle,
+       only new and changed tags are looked up."""
+    name = 'tags'
+    schema = """
+CREATE TABLE IF NOT EXISTS tags (name TEXT PRIMARY KEY, target TEXT, peeled TEXT, time INTEGER, message TEXT,
+                                 tagger_name TEXT, tagger_email TEXT, tagger_time INTEGER, commit_summary TEXT);
+CREATE INDEX IF NOT EXISTS tags_time ON tags (time);
+"""
+
+    def __init__(self, repo):
+        super(TagIndex, self).__init__(repo)
+        self.synced = False
+
+    def sync(self):
+        if self.synced:
+            return
+        refs = {}
+        for ref in self.repo.listall_references():
+            if ref.startswith('refs/tags/'):
+                refs[ref[10:]] = self.repo.lookup_reference(ref).target.hex
+        stored = dict(self.db.execute("SELECT name, target FROM tags").fetchall())
+        refs = dict([(decode(name), target) for name, target in refs.items()])
+        if stored != refs:
+            new = []
+            for name, target in refs.items():
+                if stored.get(name, None) == target:
+                    continue
+                tag = obj = self.repo[target]
+                while obj.type == pygit2.GIT_OBJ_TAG:
+                    obj = self.repo[obj.target]
+                if tag.type != pygit2.GIT_OBJ_TAG:
+                    tag = None
+                tagger = tag and tag.tagger or None
+                if obj.type != pygit2.GIT_OBJ_COMMIT:
+                    new.append((decode(name), target, None, 0, None, None, None, None, None))
+                    continue
+                new.append((decode(name), target, obj.hex, tagger and tagger.time or obj.commit_time, tag and decode(tag.message),
+                            tagger and decode(tagger.name), tagger and decode(tagger.email), tagger and tagger.time,
+                            decode(obj.message.split('\n')[0])))
+            with self.db:
+                self.db.executemany("DELETE FROM tags WHERE name=?", [(name,) for name in stored if stored[name] != refs.get(name, None)])
+                self.db.executemany("INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", new)
+        self.synced = True
+
+    def peeled(self):
+        """{commit hex: tag name} for all tags of commits"""
+        self.sync()
+        return dict(self.db.execute("SELECT peeled, name FROM tags WHERE peeled IS NOT NULL ORDER BY name").fetchall())
+
+    def recent(self, count):
+        """[(name, commit hex)] for the count most recent tags of commits"""
+        self.sync()
+        return self.db.execute("SELECT name, peeled FROM tags WHERE peeled IS NOT NULL ORDER BY time DESC, name LIMIT ?", (count,)).fetchall()
+
+    def page(self, keywords, start, count):
+        """(total, [(name, tag or None, commit)]) for tags matching all keywords, newest first"""
+        self.sync()
+        where, args = "peeled IS NOT NULL", []
+        for keyword in keywords:
+            keyword = '%%%s%%' % keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where += " AND (name LIKE ? ESCAPE '\\' OR message LIKE ? ESCAPE '\\' OR tagger_name LIKE ? ESCAPE '\\' OR tagger_email LIKE ? ESCAPE '\\')"
+            args += [keyword] * 4
+        total = self.db.execute("SELECT COUNT(*) FROM tags WHERE " + where, args).fetchone()[0]
+        rows = self.db.execute("SELECT name, peeled, message, tagger_name, tagger_email, tagger_time, commit_summary FROM tags WHERE " +
+                               where + " ORDER BY time DESC, name LIMIT ? OFFSET ?", args + [count, start])
+        tags = []
+        for name, peeled, message, tagger_name, tagger_email, tagger_time, summary in rows:
+            tag = None
+            if message is not None:
+                tag = TagInfo(message, tagger_name is not None and Signature(tagger_name, tagger_email, tagger_time) or None)
+            tags.append((name, tag, CommitInfo(peeled, summary)))
+        return total, tags
+
+class DescribeIndex(Index):
+    """Nearest tag and distance to it for commits, counted along the first
+       parent chain like git describe --first-parent. Only every 64th commit
+       of a chain is stored besides the ones asked about, so a lookup walks
+       at most that far. New entries are written in one transaction by
+       flush. When tags change, only the entries they can affect are
+       removed."""
+    name = 'describe'
+    schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS describe (oid TEXT PRIMARY KEY, tag TEXT, distance INTEGER);
+"""
+    checkpoint = 64
+
+    def __init__(self, repo):
+        super(DescribeIndex, self).__init__(repo)
+        self.tags = None
+        self.pending = {}
+
+    def sync_tags(self):
+        tags = self.repo.tag_index.peeled()
+        row = self.db.execute("SELECT value FROM meta WHERE key='peeled'").fetchone()
+        if not row:
+            with self.db:
+                self.db.execute("DELETE FROM describe")
+            self.tags = tags
+        elif json.loads(row[0]) != tags:
+            old = json.loads(row[0])
+            # Entries pointing at a removed or moved tag are invalid
+            self.tags = dict([(oid, name) for oid, name in old.items() if tags.get(oid, None) == name])
+            with self.db:
+                for oid, name in old.items():
+                    if oid not in self.tags:
+                        self.db.execute("DELETE FROM describe WHERE tag=?", (name,))
+            # A new tag only changes commits whose first parent chain passes
+            # it. Those have the same tag as the tagged commit had, further
+            # away than it.
+            for oid, name in tags.items():
+                if oid not in self.tags:
+                    tag, distance = self.lookup(oid)
+                    self.flush()
+                    with self.db:
+                        if tag is None:
+                            self.db.execute("DELETE FROM describe WHERE tag IS NULL")
+                        else:
+                            self.db.execute("DELETE FROM describe WHERE tag=? AND distance>=?", (tag, distance))
+                    self.tags[oid] = name
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('peeled', ?)", (json.dumps(tags),))
+
+    def lookup(self, commit):
+        """(tag, distance) for a commit hex, or (None, None) if no tag can be
+           reached. New entries are kept until flush is called"""
+        if self.tags is None:
+            self.sync_tags()
+        if not self.tags:
+            return None, None
+        chain = []
+        commit = self.repo[commit]
+        while True:
+            row = self.pending.get(commit.hex, None) or \
+                  self.db.execute("SELECT tag, distance FROM describe WHERE oid=?", (commit.hex,)).fetchone()
+            if row:
+                tag, distance = row
+                break
+            if commit.hex in self.tags:
+                tag, distance = self.tags[commit.hex], 0
+                break
+            chain.append(commit.hex)
+            if not commit.parents:
+                tag, distance = None, None
+                break
+            commit = commit.parents[0]
+        for num, oid in enumerate(reversed(chain)):
+            if distance is not None:
+                distance += 1
+            if num == len(chain) - 1 or not (len(chain) - num) % self.checkpoint:
+                self.pending[oid] = (tag, distance)
+        return tag, distance
+
+    def flush(self):
+        if self.pending:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO describe (oid, tag, distance) VALUES (?, ?, ?)",
+                                    [(oid, tag, distance) for oid, (tag, distance) in self.pending.items()])
+            self.pending = {}
+
+    def describe(self, commit):
+        tag, distance = self.lookup(commit)
+        self.flush()
+        if tag is None:
+            return 'g' + commit[:7]
+        if distance == 0:
+            return tag
+        return '%s-%d-g%s' % (tag, distance, commit[:7])
+
+def literals(pattern):
+    """Runs of literal text that anything matching a grep regex must contain,
+       or None for alternations and groups, which can't be narrowed down.
+       git grep may be configured to use extended or perl regexes, so ( ) ? and
+       + are never taken literally"""
+    if re.search(r'[|()?+]', pattern):
+        return None
+    runs, run, pos = [], '', 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '[':
+            # Skip bracket expressions, ] directly after [ or [^ is literal
+            end = pos + 1
+            if pattern[end:end+1] == '^':
+                end += 1
+            if pattern[end:end+1] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end == -1:
+                return None
+            runs.append(run)
+            run, pos = '', end
+        elif char in '*?+{':
+            # The quantified character is optional
+            runs.append(run[:-1])
+            run = ''
+            if char == '{':
+                pos = max(pos, pattern.find('}', pos))
+        elif char == '\\':
+            # \{ \? and \+ are quantifiers too
+            runs.append(pattern[pos+1:pos+2] in '{?+' and run[:-1] or run)
+            run = ''
+            pos += 1
+        elif char in '.^$':
+            runs.append(run)
+            run = ''
+        else:
+            run += char
+        pos += 1
+    runs.append(run)
+    return [run for run in runs if len(run) >= 3]
+
+def trigrams(data):
+    data = data.lower()
+    return set([(ord(data[i]) << 16) | (ord(data[i+1]) << 8) | ord(data[i+2])
+                for i in xrange(len(data) - 2) if '\n' not in data[i:i+3]])
+
+class TrigramIndex(Index):
+    """Trigrams of the files of the default branch and the most recent tags,
+       like codesearch or zoekt, so code search only needs to grep files that
+       can match. Trigrams are stored per blob, so a blob is only indexed
+       once no matter how many roots contain it. Roots are updated from the
+       paths that changed since they were last indexed."""
+    name = 'trigrams'
+    schema = """
+CREATE TABLE IF NOT EXISTS roots (ref TEXT PRIMARY KEY, oid TEXT);
+CREATE TABLE IF NOT EXISTS files (ref TEXT, path TEXT, blob INTEGER, PRIMARY KEY (ref, path));
+CREATE INDEX IF NOT EXISTS files_blob ON files (blob);
+CREATE TABLE IF NOT EXISTS blobs (id INTEGER PRIMARY KEY, oid TEXT UNIQUE, indexed INTEGER);
+CREATE TABLE IF NOT EXISTS postings (trigram INTEGER, blob INTEGER, PRIMARY KEY (trigram, blob));
+"""
+    # Bigger blobs aren't indexed and are always searched
+    max_size = 1024 * 1024
+    # Any subset of a query's trigrams gives correct results, a few are enough
+    max_trigrams = 16
+
+    def update(self, tags=0):
+        """Index the default branch and the most recent tags"""
+        roots = {}
+        head = self.repo.head
+        if head:
+            roots[head.name] = head.target.hex
+        for name, oid in self.repo.tag_index.recent(tags):
+            roots['refs/tags/' + name] = oid
+        stored = dict(self.db.execute("SELECT ref, oid FROM roots").fetchall())
+        # Blobs that files no longer point to, candidates for removal
+        dropped = set()
+        with self.db:
+            for ref in stored:
+                if ref not in roots:
+                    dropped.update([blob for blob, in self.db.execute("SELECT blob FROM files WHERE ref=?", (ref,))])
+                    self.db.execute("DELETE FROM files WHERE ref=?", (ref,))
+                    self.db.execute("DELETE FROM roots WHERE ref=?", (ref,))
+        for ref, oid in roots.items():
+            if stored.get(ref, None) != oid:
+                self.update_root(ref, stored.get(ref, None), oid, dropped)
+        self.gc(dropped)
+
+    def gc(self, blobs):
+        """Remove the blobs no file uses anymore. Their postings are found by
+           their trigrams, so postings never need to be scanned"""
+        with self.db:
+            for blob in blobs:
+                if self.db.execute("SELECT 1 FROM files WHERE blob=? LIMIT 1", (blob,)).fetchone():
+                    continue
+                row = self.db.execute("SELECT oid, indexed FROM blobs WHERE id=?", (blob,)).fetchone()
+                if not row:
+                    continue
+                if row[1]:
+                    self.db.executemany("DELETE FROM postings WHERE trigram=? AND blob=?",
+                                        [(gram, blob) for gram in trigrams(self.repo[row[0]].data)])
+                self.db.execute("DELETE FROM blobs WHERE id=?", (blob,))
+
+    def update_root(self, ref, old, new, dropped):
+        try:
+            old_tree = old and self.repo[old].tree or None
+        except KeyError:
+            old_tree = None
+        new_tree = self.repo[new].tree
+        with self.db:
+            if old_tree is None:
+                dropped.update([blob for blob, in self.db.execute("SELECT blob FROM files WHERE ref=?", (ref,))])
+                self.db.execute("DELETE FROM files WHERE ref=?", (ref,))
+            for path in changed_paths(self.repo, old_tree, new_tree):
+                row = self.db.execute("SELECT blob FROM files WHERE ref=? AND path=?", (ref, decode(path))).fetchone()
+                if row:
+                    dropped.add(row[0])
+                entry = self.entry(new_tree, path)
+                if entry is None or not stat.S_ISREG(entry.filemode):
+                    self.db.execute("DELETE FROM files WHERE ref=? AND path=?", (ref, decode(path)))
+                else:
+                    self.db.execute("INSERT OR REPLACE INTO files (ref, path, blob) VALUES (?, ?, ?)", (ref, decode(path), self.blob_id(entry.hex)))
+            self.db.execute("INSERT OR REPLACE INTO roots (ref, oid) VALUES (?, ?)", (ref, new))
+
+    def entry(self, tree, path):
+        parts = path.split('/')
+        for part in parts[:-1]:
+            if part not in tree or not stat.S_ISDIR(tree[part].filemode):
+                return None
+            tree = self.repo[tree[part].oid]
+        if parts[-1] not in tree:
+            return None
+        return tree[parts[-1]]
+
+    def blob_id(self, oid):
+        row = self.db.execute("SELECT id FROM blobs WHERE oid=?", (oid,)).fetchone()
+        if row:
+            return row[0]
+        blob = self.repo[oid]
+        grams = None
+        if blob.size <= self.max_size:
+            data = blob.data
+            if '\0' not in data[:8000]:
+                grams = trigrams(data)
+        blob = self.db.execute("INSERT INTO blobs (oid, indexed) VALUES (?, ?)", (oid, grams is not None and 1 or 0)).lastrowid
+        if grams:
+            self.db.executemany("INSERT INTO postings (trigram, blob) VALUES (?, ?)", [(gram, blob) for gram in grams])
+        return blob
+
+    def candidates(self, commit, path, pattern):
+        """Paths of files under path in commit that may match pattern, or None
+           if the index can't tell"""
+        row = self.db.execute("SELECT ref FROM roots WHERE oid=? LIMIT 1", (commit,)).fetchone()
+        runs = literals(pattern)
+        if not row or not runs:
+            return None
+        grams = set()
+        for run in runs:
+            grams.update(trigrams(utf8(run)))
+        grams = sorted(grams)[:self.max_trigrams]
+        path = path.strip('/')
+        prefix = path and path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%' or '%'
+        rows = self.db.execute("SELECT path FROM files WHERE ref=? AND (path=? OR path LIKE ? ESCAPE '\\') AND " +
+                               "(blob IN (SELECT id FROM blobs WHERE indexed=0) OR blob IN (" +
+                               " INTERSECT ".join(["SELECT blob FROM postings WHERE trigram=?"] * len(grams)) + ")) ORDER BY path",
+                               [row[0], path, prefix] + grams)
+        return [utf8(path) for path, in rows]
+
+word_re = re.compile(r'\w+', re.UNICODE)
+trailer_re = re.compile(r'^([-a-z]+(?:-[a-z]+)*):(.+?)(?:<.*)?\n', flags=re.MULTILINE|re.I)
+
+def tokens(text):
+    return set([word.lower() for word in word_re.findall(text)])
+
+def commit_terms(commit):
+    """Words of the message, author and committer, and trailer:word terms
+       for the trailers of the message, all lowercased"""
+    message = decode(commit.message)
+    terms = tokens(message)
+    for person in (commit.author, commit.committer):
+        email = decode(person.email).lower()
+        terms |= tokens(decode(person.name)) | tokens(email)
+        terms.add(email)
+    if '\n' in message:
+        for key, value in trailer_re.findall(message.split('\n', 1)[1]):
+            terms.update(['%s:%s' % (key.lower(), word) for word in tokens(value)])
+    return terms
+
+def query_terms(query):
+    """Terms that commit_terms of a matching commit must have prefixes of. A
+       word like signed-off-by:name searches trailers"""
+    terms = []
+    for word in query.split():
+        key, _, value = word.partition(':')
+        if key and value and re.match(r'^[-a-z]+$', key, re.I):
+            terms += ['%s:%s' % (key.lower(), token) for token in tokens(value)]
+        else:
+            terms += tokens(word)
+    return terms
+
+def matches(terms, query):
+    return all([any([term.startswith(word) for term in terms]) for word in query])
+
+class MessageIndex(Index):
+    """Inverted index of commit messages, authors, committers and trailers
+       for log search. Commits reachable from branches and tags are indexed,
+       new ones are added when the refs have changed. Searches match all
+       words as prefixes of indexed terms."""
+    name = 'messages'
+    schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY, oid TEXT UNIQUE, time INTEGER);
+CREATE INDEX IF NOT EXISTS commits_time ON commits (time);
+CREATE TABLE IF NOT EXISTS terms (term TEXT, commit_id INTEGER, PRIMARY KEY (term, commit_id));
+"""
+    # Catching up with more new commits than this is left to warm
+    max_new = 5000
+    # Commit times can be a bit off, allow for that when skipping commits
+    # newer than the one searched from
+    clock_skew = 86400
+
+    def __init__(self, repo):
+        super(MessageIndex, self).__init__(repo)
+        self.synced = False
+
+    def tips(self):
+        tips = set()
+        for ref in self.repo.listall_references():
+            if ref.startswith('refs/heads/') or ref.startswith('refs/tags/'):
+                obj = self.repo[self.repo.lookup_reference(ref).target]
+                while obj.type == pygit2.GIT_OBJ_TAG:
+                    obj = self.repo[obj.target]
+                if obj.type == pygit2.GIT_OBJ_COMMIT:
+                    tips.add(obj.hex)
+        return sorted(tips)
+
+    def update(self, limit=None):
+        """Index all commits that aren't indexed yet. Gives up and returns
+           False if there are more than limit of them"""
+        if self.synced:
+            return True
+        row = self.db.execute("SELECT value FROM meta WHERE key='tips'").fetchone()
+        indexed = row and json.loads(row[0]) or []
+        tips = self.tips()
+        if tips and tips != indexed:
+            walker = self.repo.walk(tips[0], pygit2.GIT_SORT_NONE)
+            for tip in tips[1:]:
+                walker.push(tip)
+            for tip in indexed:
+                try:
+                    walker.hide(tip)
+                except (KeyError, ValueError):
+                    # Gone, probably a rewound branch
+                    pass
+            new = []
+            for num, commit in enumerate(walker):
+                if limit and num >= limit:
+                    return False
+                new.append(commit)
+                # With a limit, nothing is written until it's known to be met
+                if not limit and len(new) >= 1000:
+                    self.add(new)
+                    new = []
+            self.add(new)
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('tips', ?)", (json.dumps(tips),))
+        self.synced = True
+        return True
+
+    def add(self, commits):
+        with self.db:
+            for commit in commits:
+                cursor = self.db.execute("INSERT OR IGNORE INTO commits (oid, time) VALUES (?, ?)", (commit.hex, commit.commit_time))
+                if cursor.rowcount:
+                    self.db.executemany("INSERT OR IGNORE INTO terms (term, commit_id) VALUES (?, ?)",
+                                        [(term, cursor.lastrowid) for term in commit_terms(commit)])
+
+    def search(self, commit, query):
+        """Commits reachable from commit that match query, newest first. None
+           if the index can't answer, and history needs to be walked"""
+        words = query_terms(query)
+        if not words or not self.update(self.max_new):
+            return None
+        if not self.db.execute("SELECT 1 FROM commits WHERE oid=?", (commit,)).fetchone():
+            return None
+        return self.hits(commit, words)
+
+    def hits(self, commit, words):
+        """Indexed commits matching words that commit can reach. Rows are
+           read lazily, and history is walked from commit only as far as the
+           oldest hit so far, so a page only costs as much as it shows"""
+        rows = self.db.execute("SELECT oid, time FROM commits WHERE time <= ? AND " +
+                               " AND ".join(["id IN (SELECT commit_id FROM terms WHERE term >= ? AND term < ?)"] * len(words)) +
+                               " ORDER BY time DESC, id DESC",
+                               [self.repo[commit].commit_time + self.clock_skew] + sum([[word, word + u'\uffff'] for word in words], []))
+        walker = iter(self.repo.walk(commit, pygit2.GIT_SORT_TIME))
+        reachable, oldest = set(), None
+        for oid, time in rows:
+            while walker and (oldest is None or oldest >= time - self.clock_skew):
+                try:
+                    walked = walker.next()
+                except StopIteration:
+                    walker = None
+                    break
+                reachable.add(walked.hex)
+                oldest = walked.commit_time
+            if oid in reachable:
+                yield self.repo[oid]
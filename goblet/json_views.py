@@ -2,13 +2,33 @@
 # Copyright (C) 2012-2014 Dennis Kaarsemaker
 # See the LICENSE file for licensing details
 
-from goblet.views import PathView
+from goblet.views import PathView, RefView, NotFound
 from goblet.filters import shortmsg
+from goblet.cache import repo_cache
+from goblet.render import render
 from jinja2 import escape
 import json
-from flask import send_file, request, redirect, config, current_app
+from flask import send_file, request, redirect, config, current_app, jsonify, render_template
 import os
 
+def tree_changed(repo, commit, path):
+    """Last change data for the files in a directory, as json"""
+    tree = commit.tree
+    for elt in path.split('/'):
+        if elt:
+            tree = repo[tree[elt].hex]
+    lastchanged = repo.tree_lastchanged(commit, path)
+    commits = {}
+    for commit in set(lastchanged.values()):
+        commit = repo[commit]
+        commits[commit.hex] = [commit.commit_time, escape(shortmsg(commit.message))]
+    for file in lastchanged:
+        lastchanged[file] = (lastchanged[file], tree[file].hex[:7])
+    return json.dumps({'files': lastchanged, 'commits': commits})
+
+def tree_changed_key(commit, path):
+    return 'dirlog_%s_%s.json' % (commit.hex, path.replace('/', '_'))
+
 class TreeChangedView(PathView):
     def handle_request(self, repo, path):
         ref, path, tree, _ = self.split_ref(repo, path)
@@ -19,28 +39,29 @@ class TreeChangedView(PathView):
             ref = repo.lookup_reference('refs/heads/%s' % ref).target.hex
         if hasattr(repo[ref], 'target'):
             ref = repo[repo[ref].target].hex
-        cfile = os.path.join(repo.cpath, 'dirlog_%s_%s.json' % (ref, path.replace('/', '_')))
-        if not os.path.exists(cfile):
-            tree = repo[ref].tree
-            for elt in path.split('/'):
-                if elt:
-                    tree = repo[tree[elt].hex]
-            lastchanged = repo.tree_lastchanged(repo[ref], path)
-            commits = {}
-            for commit in set(lastchanged.values()):
-                commit = repo[commit]
-                commits[commit.hex] = [commit.commit_time, escape(shortmsg(commit.message))]
-            for file in lastchanged:
-                lastchanged[file] = (lastchanged[file], tree[file].hex[:7])
-            ret = {'files': lastchanged, 'commits': commits}
-            if not current_app.config['TESTING']:
-                with open(cfile, 'w') as fd:
-                    json.dump(ret, fd)
         if current_app.config['TESTING']:
             # When testing, we're not writing to the file, so we can't send_file or redirect
-            return json.dumps(ret)
-        elif 'wsgi.version' in request.environ and request.environ['SERVER_PORT'] != '5000':
+            return tree_changed(repo, repo[ref], path)
+        cfile = repo_cache(repo).compute(tree_changed_key(repo[ref], path), lambda: tree_changed(repo, repo[ref], path))
+        if 'wsgi.version' in request.environ and request.environ['SERVER_PORT'] != '5000':
             # Redirect to the file, let the webserver deal with it
             return redirect(cfile.replace(current_app.config['REPO_ROOT'], ''))
         else:
             return send_file(cfile)
+
+class BlobWindowView(PathView):
+    content_only = True
+    def handle_request(self, repo, path):
+        ref, path, tree, file = self.split_ref(repo, path, expects_file=True)
+        renderer, html = render(repo, ref, path, file, blame=request.args.get('blame') == '1',
+                                line=request.args.get('line', None, type=int))
+        return jsonify(html=html)
+
+class FileDiffView(RefView):
+    content_only = True
+    def handle_request(self, repo, ref, num):
+        commit = self.lookup_ref(repo, ref)
+        diff = repo.commit_diff(commit)
+        if num >= len(diff):
+            raise NotFound("No such file")
+        return jsonify(html=render_template('diff_file.html', repo=repo, commit=commit, file=diff[num]))
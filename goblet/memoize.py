@@ -2,17 +2,77 @@
 # Copyright (C) 2012-2014 Dennis Kaarsemaker
 # See the LICENSE file for licensing details
 
-class memoize:
-    def __init__(self, function):
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+caches = []
+
+class Memoized(object):
+    """LRU cache around a function. Entries expire after ttl seconds, and are
+       recomputed when valid(*args) returns something else than it did when
+       the entry was stored. Repositories are keyed by their path."""
+    def __init__(self, function, maxsize=None, ttl=None, valid=None):
         self.function = function
-        self.memoized = {}
+        self.name = '%s.%s' % (function.__module__, function.__name__)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.valid = valid
+        self.memoized = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        caches.append(self)
 
     def __call__(self, *args):
         args_ = args
         if args and hasattr(args[0], 'path'):
             args_ = (args[0].path,) + args[1:]
-        try:
-            return self.memoized[args_]
-        except KeyError:
-            self.memoized[args_] = self.function(*args)
-        return self.memoized[args_]
+        validity = self.valid and self.valid(*args)
+        now = time.time()
+        with self.lock:
+            if args_ in self.memoized:
+                value, validity_, expires = self.memoized.pop(args_)
+                if validity_ == validity and (not expires or expires > now):
+                    self.memoized[args_] = (value, validity_, expires)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        value = self.function(*args)
+        with self.lock:
+            self.memoized[args_] = (value, validity, self.ttl and now + self.ttl)
+            while self.maxsize and len(self.memoized) > self.maxsize:
+                self.memoized.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def __get__(self, obj, cls=None):
+        # Bind to instances when used on methods
+        if obj is None:
+            return self
+        return functools.partial(self, obj)
+
+    def peek(self, *args):
+        """Return a cached value without computing it or touching the LRU
+           order or counters. Returns None if nothing is cached"""
+        if args and hasattr(args[0], 'path'):
+            args = (args[0].path,) + args[1:]
+        entry = self.memoized.get(args, None)
+        if entry and (not entry[2] or entry[2] > time.time()):
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.memoized.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.memoized)}
+
+def memoize(function=None, maxsize=None, ttl=None, valid=None):
+    """Use as @memoize or @memoize(maxsize=..., ttl=..., valid=...)"""
+    if function is None:
+        return lambda function: Memoized(function, maxsize, ttl, valid)
+    return Memoized(function)
+
+def stats():
+    return dict([(cache.name, cache.stats()) for cache in caches])
@@ -7,12 +7,145 @@ import pygit2
 from flask import current_app
 from memoize import memoize
 import pwd
+import difflib
+import hashlib
+import heapq
+import json
 import pygments.lexers
 import stat
+import subprocess
+import threading
+import time
 from whelk import shell
 from goblet.encoding import decode
+from goblet.cache import repo_cache
+from goblet.index import ChangedPathIndex, DescribeIndex, MessageIndex, TagIndex, TrigramIndex, utf8
+from goblet.index import commit_terms, query_terms, matches
 from collections import defaultdict
 
+# Subdirectories of the ref directories of each repository, with the mtime of
+# the directory they were listed at
+ref_dirs = {}
+
+def refs_stamp(path, extra=()):
+    """Cheap fingerprint of the refs: mtimes of HEAD, packed-refs and the
+       ref directories. Any ref update renames a lockfile into one of these,
+       so the stamp changes whenever a ref does. Only directories whose mtime
+       changed are listed again, so loose refs are never stat'ed"""
+    stamp = [mtime(os.path.join(path, x)) for x in ('HEAD', 'packed-refs', 'refs') + tuple(extra)]
+    known = ref_dirs.setdefault(path, {})
+    todo = [os.path.join(path, 'refs', 'tags'), os.path.join(path, 'refs', 'heads')]
+    while todo:
+        dir = todo.pop()
+        stamp.append(mtime(dir))
+        if stamp[-1] is None:
+            continue
+        if dir not in known or known[dir][0] != stamp[-1]:
+            subdirs = sorted([os.path.join(dir, x) for x in os.listdir(dir) if os.path.isdir(os.path.join(dir, x))])
+            known[dir] = (stamp[-1], subdirs)
+        todo.extend(reversed(known[dir][1]))
+    return tuple(stamp)
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class RefIndex(object):
+    """Branches and tags of a repository, in tries keyed on path segments so
+       the longest ref a url path starts with can be found in time
+       proportional to the depth of the path. Refs are peeled to commits
+       on first use."""
+    def __init__(self, repo):
+        self.repo = repo
+        self.tries = {'heads': {}, 'tags': {}}
+        self.branches = []
+        self.tags = []
+        for ref in repo.listall_references():
+            if ref.startswith('refs/heads/'):
+                kind, name = 'heads', ref[11:]
+                self.branches.append(name)
+            elif ref.startswith('refs/tags/'):
+                kind, name = 'tags', ref[10:]
+                self.tags.append(name)
+            else:
+                continue
+            node = self.tries[kind]
+            for part in name.split('/'):
+                node = node.setdefault(part, {})
+            node[None] = [name, ref, None]
+        self.branches.sort()
+        self.tags.sort()
+
+    def peel(self, leaf):
+        if leaf[2] is None:
+            obj = self.repo[self.repo.lookup_reference(leaf[1]).target]
+            while obj.type == pygit2.GIT_OBJ_TAG:
+                obj = self.repo[obj.target]
+            leaf[2] = obj.hex
+        return leaf[2]
+
+    def lookup(self, path):
+        """Find the longest branch, or failing that the longest tag, that
+           path starts with. Returns (kind, name, commit hex, rest of path)
+           or None"""
+        parts = path.split('/')
+        for kind in ('heads', 'tags'):
+            node, found = self.tries[kind], None
+            for num, part in enumerate(parts):
+                node = node.get(part, None)
+                if node is None:
+                    break
+                if None in node:
+                    found = (node[None], '/'.join(parts[num+1:]))
+            if found:
+                leaf, rest = found
+                return kind, leaf[0], self.peel(leaf), rest
+        return None
+
+class BlobReader(object):
+    """Contents of a blob, streamed from git cat-file so big blobs never have
+       to fit in memory. The size and the first sample_size bytes are known
+       before reading starts, iterating yields the bytes from start to end"""
+    sample_size = 8000
+    chunk_size = 65536
+
+    def __init__(self, repo, oid):
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(['git', '--git-dir', repo.path, 'cat-file', '--batch'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        self.proc.stdin.write('%s\n' % oid)
+        self.proc.stdin.close()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3 or header[1] != 'blob':
+            self.close()
+            raise KeyError(oid)
+        self.size = int(header[2])
+        self.sample = self.proc.stdout.read(min(self.size, self.sample_size))
+        self.start, self.end = 0, self.size
+
+    def __iter__(self):
+        try:
+            pos, data = 0, self.sample
+            while pos < self.end:
+                if not data:
+                    data = self.proc.stdout.read(min(self.chunk_size, self.end - pos))
+                    if not data:
+                        break
+                if pos + len(data) > self.start:
+                    yield data[max(0, self.start - pos):self.end - pos]
+                pos += len(data)
+                data = None
+        finally:
+            self.close()
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+
 class Repository(pygit2.Repository):
     def __init__(self, path):
         if os.path.exists(path):
@@ -26,7 +159,14 @@ class Repository(pygit2.Repository):
         if not os.path.exists(self.cpath):
             os.mkdir(self.cpath)
 
-    @memoize
+    # Set by the pool when the handle is checked, so the refs only need to be
+    # looked at once per request
+    stamp = None
+
+    def refs_stamp(self):
+        return self.stamp or refs_stamp(self.path)
+
+    @memoize(maxsize=1000, valid=lambda self: mtime(os.path.join(self.path, 'description')))
     def get_description(self):
         desc = os.path.join(self.path, 'description')
         if not os.path.exists(desc):
@@ -35,7 +175,7 @@ class Repository(pygit2.Repository):
             return decode(fd.read())
     description = property(get_description)
 
-    @memoize
+    @memoize(maxsize=1000)
     def get_name(self):
         name = self.path.replace(current_app.config['REPO_ROOT'], '')
         if name.startswith('/'):
@@ -47,7 +187,7 @@ class Repository(pygit2.Repository):
         return name
     name = property(get_name)
 
-    @memoize
+    @memoize(maxsize=1000, valid=lambda self: mtime(os.path.join(self.path, 'config')))
     def get_clone_urls(self):
         clone_base = current_app.config.get('CLONE_URLS_BASE', {})
         repo_root = current_app.config['REPO_ROOT']
@@ -67,7 +207,7 @@ class Repository(pygit2.Repository):
         return ret
     clone_urls = property(get_clone_urls)
 
-    @memoize
+    @memoize(maxsize=1000, ttl=3600, valid=lambda self: mtime(os.path.join(self.path, 'config')))
     def get_owner(self):
         try:
             return self.config['goblet.owner']
@@ -81,13 +221,26 @@ class Repository(pygit2.Repository):
             return pwn.pw_name
     owner = property(get_owner)
 
+    @property
+    def ref_index(self):
+        # Pooled handles are reopened when refs change, so this never goes stale
+        if getattr(self, '_ref_index', None) is None:
+            self._ref_index = RefIndex(self)
+        return self._ref_index
+
+    @property
+    def changed_paths(self):
+        if getattr(self, '_changed_paths', None) is None:
+            self._changed_paths = ChangedPathIndex(self)
+        return self._changed_paths
+
     def branches(self):
-        return sorted([x[11:] for x in self.listall_references() if x.startswith('refs/heads/')])
+        return self.ref_index.branches
 
     def tags(self):
-        return sorted([x[10:] for x in self.listall_references() if x.startswith('refs/tags/')])
+        return self.ref_index.tags
 
-    @memoize
+    @memoize(maxsize=100, valid=lambda self: self.refs_stamp())
     def get_reverse_refs(self):
         ret = defaultdict(list)
         for ref in self.listall_references():
@@ -119,22 +272,41 @@ class Repository(pygit2.Repository):
         except pygit2.GitError:
             return None
 
-    def get_commits(self, ref, skip, count, search=None, file=None):
+    def get_commits(self, ref, skip, count, search=None, file=None, cursor=None, pending=None):
+        """Walk history from ref, or from the commits in cursor. If pending is
+           a set, it is updated with the commits the walk would continue
+           with, so a next page can resume from there instead of skipping"""
         num = 0
         path = []
+        words = search and query_terms(search)
         if file:
+            file = file.strip('/')
             path = file.split('/')
-        for commit in self.walk(ref.hex, pygit2.GIT_SORT_TIME):
-            if search and search not in commit.message:
+        tips = cursor or [ref.hex]
+        walker = self.walk(tips[0], pygit2.GIT_SORT_TIME)
+        for tip in tips[1:]:
+            walker.push(tip)
+        if pending is None:
+            pending = set()
+        pending.update(tips)
+        for commit in walker:
+            pending.discard(commit.hex)
+            pending.update([parent.hex for parent in commit.parents])
+            if words and not matches(commit_terms(commit), words):
+                continue
+            if search and not words and search not in commit.message:
+                continue
+            if path and not self.changed_paths.maybe_changed(commit, file):
                 continue
             if path:
                 in_current = found_same = in_parent = False
+                oid = None
                 try:
                     tree = commit.tree
-                    for file in path[:-1]:
-                        tree = self[tree[file].hex]
+                    for dir in path[:-1]:
+                        tree = self[tree[dir].hex]
                         if not isinstance(tree, pygit2.Tree):
-                            raise KeyError(file)
+                            raise KeyError(dir)
                     oid = tree[path[-1]].oid
                     in_current = True
                 except KeyError:
@@ -142,10 +314,10 @@ class Repository(pygit2.Repository):
                 try:
                     for parent in commit.parents:
                         tree = parent.tree
-                        for file in path[:-1]:
-                            tree = self[tree[file].hex]
+                        for dir in path[:-1]:
+                            tree = self[tree[dir].hex]
                             if not isinstance(tree, pygit2.Tree):
-                                raise KeyError(file)
+                                raise KeyError(dir)
                         if tree[path[-1]].oid == oid:
                             in_parent = found_same = True
                             break
@@ -161,23 +333,47 @@ class Repository(pygit2.Repository):
             if num < skip:
                 continue
             if num >= skip + count:
+                pending.add(commit.hex)
                 break
             yield commit
+        if path:
+            self.changed_paths.flush()
+
+    @property
+    def tag_index(self):
+        if getattr(self, '_tag_index', None) is None:
+            self._tag_index = TagIndex(self)
+        return self._tag_index
+
+    @property
+    def message_index(self):
+        if getattr(self, '_message_index', None) is None:
+            self._message_index = MessageIndex(self)
+        return self._message_index
+
+    @property
+    def trigram_index(self):
+        # Optional, only used once warm has built it
+        if getattr(self, '_trigram_index', None) is None and os.path.exists(os.path.join(self.gpath, 'trigrams.sqlite')):
+            self._trigram_index = TrigramIndex(self)
+        return getattr(self, '_trigram_index', None)
+
+    @property
+    def describe_index(self):
+        if getattr(self, '_describe_index', None) is None:
+            self._describe_index = DescribeIndex(self)
+        return self._describe_index
 
     def describe(self, commit):
-        tags = [self.lookup_reference(x) for x in self.listall_references() if x.startswith('refs/tags')]
-        if not tags:
-            return 'g' + commit[:7]
-        tags = [(tag.name[10:], self[tag.target.hex]) for tag in tags]
-        tags = dict([(hasattr(obj, 'target') and self[obj.target].hex or obj.hex, name) for name, obj in tags])
-        count = 0
-        for parent in self.walk(commit, pygit2.GIT_SORT_TIME):
-            if parent.hex in tags:
-                if count == 0:
-                    return tags[parent.hex]
-                return '%s-%d-g%s' % (tags[parent.hex], count, commit[:7])
-            count += 1
-        return 'g' + commit[:7]
+        if hasattr(commit, 'hex'):
+            commit = commit.hex
+        return self.describe_index.describe(commit)
+
+    def versions(self, commits):
+        """{commit hex: (nearest tag, distance)} for commits, stored in one go"""
+        ret = dict([(commit.hex, self.describe_index.lookup(commit.hex)) for commit in commits])
+        self.describe_index.flush()
+        return ret
 
     def ls_tree(self, tree, path=''):
         ret = []
@@ -190,58 +386,286 @@ class Repository(pygit2.Repository):
 
     def tree_lastchanged(self, commit, path):
         """Get a dict of {name: hex} for commits that last changed files in a directory"""
-        data = self.git('blame-tree', '--max-depth=0', commit.hex, '--', os.path.join('.', path) + os.sep).stdout
-        data = data.decode('utf-8').splitlines()
-        if not data:
-            raise ValueError("Empty blame-tree output")
-        data = [x.split(None, 1) for x in data]
-        if path:
-            data = [(p[p.rfind('/')+1:], m) for (m,p) in data]
-        else:
-            data = [(p, m) for (m,p) in data]
-        return dict(data)
+        return dict(self._tree_lastchanged(commit.hex, path.strip('/')))
+
+    def subtree(self, commit, path):
+        tree = commit.tree
+        for dir in path:
+            if dir not in tree or not stat.S_ISDIR(tree[dir].filemode):
+                return None
+            tree = self[tree[dir].oid]
+        return tree
+
+    @memoize(maxsize=1000)
+    def _tree_lastchanged(self, commit, path):
+        # Walk history in time order, following a single parent when the
+        # directory is unchanged, like git log's history simplification. An
+        # entry is resolved at the first commit that has its current
+        # version while none of its parents do. Parents that have none of
+        # the unresolved versions can't lead to a resolution, so they are
+        # not walked at all.
+        parts = [x for x in path.split('/') if x]
+        commit = self[commit]
+        tree = self.subtree(commit, parts)
+        unresolved = dict([(entry.name, (entry.hex, entry.filemode)) for entry in tree])
+        result = {}
+
+        # If the parent directory was done already for this commit, nothing
+        # in this directory changed after the commit that last changed it
+        if parts:
+            parent = Repository._tree_lastchanged.peek(self, commit.hex, '/'.join(parts[:-1]))
+            if parent and parts[-1] in parent:
+                commit = self[parent[parts[-1]]]
+
+        trees = {commit.hex: tree}
+        queue = [(-commit.commit_time, commit.hex)]
+        seen = set([commit.hex])
+        while queue and unresolved:
+            commit = self[heapq.heappop(queue)[1]]
+            tree = trees.pop(commit.hex)
+            parents = []
+            for parent in commit.parents:
+                parents.append((parent, trees.get(parent.hex, None) or self.subtree(parent, parts)))
+            same = [parent for parent, ptree in parents if ptree is not None and ptree.hex == tree.hex]
+            if same:
+                parents = [(same[0], tree)]
+            else:
+                entries = dict([(entry.name, (entry.hex, entry.filemode)) for entry in tree])
+                pentries = [dict([(entry.name, (entry.hex, entry.filemode)) for entry in (ptree or [])]) for parent, ptree in parents]
+                for name, version in unresolved.items():
+                    if entries.get(name, None) == version and not [x for x in pentries if x.get(name, None) == version]:
+                        result[name] = commit.hex
+                        del unresolved[name]
+                parents = [(parent, ptree) for (parent, ptree), pentry in zip(parents, pentries)
+                           if [name for name in unresolved if pentry.get(name, None) == unresolved[name]]]
+            for parent, ptree in parents:
+                if parent.hex not in seen:
+                    seen.add(parent.hex)
+                    trees[parent.hex] = ptree
+                    heapq.heappush(queue, (-parent.commit_time, parent.hex))
+        return result
+
+    def commit_diff(self, commit):
+        """Diff of a commit against its first parent"""
+        if not commit.parents:
+            return commit.tree.diff_to_tree(swap=True)
+        return commit.parents[0].tree.diff_to_tree(commit.tree)
+
+    def diff_stat(self, commit):
+        """[{'old': path, 'new': path, '+': additions, '-': deletions, 'binary':
+           bool}] for the files changed by a commit, cached per commit"""
+        def stat():
+            files = []
+            for patch in self.commit_diff(commit):
+                if hasattr(patch, 'line_stats'):
+                    _, additions, deletions = patch.line_stats
+                elif hasattr(patch, 'additions'):
+                    additions, deletions = patch.additions, patch.deletions
+                else:
+                    # Older pygit2 doesn't count for us
+                    additions = deletions = 0
+                    for hunk in patch.hunks:
+                        for line in hunk.lines:
+                            additions += line[0] == '+'
+                            deletions += line[0] == '-'
+                files.append({'old': decode(patch.old_file_path), 'new': decode(patch.new_file_path),
+                              '+': additions, '-': deletions, 'binary': not patch.hunks})
+            return json.dumps(files)
+        with open(repo_cache(self).compute('diffstat_%s.json' % commit.hex, stat)) as fd:
+            return json.load(fd)
+
+    def format_patch(self, commit):
+        """Path to a cached patch of a commit, like git format-patch makes"""
+        return repo_cache(self).compute('patch_%s.patch' % commit.hex, lambda: format_patch(commit, self.diff_stat(commit), self.commit_diff(commit)))
 
     def blame(self, commit, path):
-        if hasattr(commit, 'hex'):
-            commit = commit.hex
-        contents = decode(self.git('blame', '-p', commit, '--', path).stdout).split('\n')
+        """[(original line number, commit)] for all lines of a file, commits
+           being dicts with hex, summary and committer-time"""
+        if not hasattr(commit, 'hex'):
+            # Branch names as well as shas
+            match = self.ref_index.lookup(commit)
+            commit = self[match and not match[3] and match[2] or commit]
+        path = path.strip('/')
+        cache = repo_cache(self)
+        with open(cache.compute(blame_key(commit.hex, path), lambda: json.dumps(self._blame(commit, path), separators=(',', ':')))) as fd:
+            data = json.load(fd)
+        commits = [{'hex': hex, 'summary': summary, 'committer-time': time} for hex, summary, time in data['commits']]
+        return [(orig_line, commits[idx]) for idx, orig_line in data['lines']]
+
+    def blob_at(self, commit, path):
+        parts = path.split('/')
+        tree = self.subtree(commit, parts[:-1])
+        if tree is None or parts[-1] not in tree or stat.S_ISDIR(tree[parts[-1]].filemode):
+            return None
+        return tree[parts[-1]].hex
+
+    def _blame(self, commit, path):
+        # Blames are stored as {'commits': [[hex, summary, time]], 'lines':
+        # [[commit index, original line number]]}. Follow single parents
+        # while the file is unchanged, as the blame is the same, and reuse a
+        # cached blame found that way. If the file did change, lines the
+        # diff says are unchanged keep their annotation, the rest is
+        # attributed to the commit that changed it.
+        cache = repo_cache(self)
+        blob = self.blob_at(commit, path)
+        base = commit
+        for _ in range(100):
+            if not blob or len(base.parents) != 1:
+                break
+            parent = base.parents[0]
+            pblob = self.blob_at(parent, path)
+            cached = pblob and cache.get(blame_key(parent.hex, path))
+            if cached:
+                with open(cached) as fd:
+                    old = json.load(fd)
+                if pblob == blob:
+                    return old
+                old_lines, new_lines = split_lines(self[pblob].data), split_lines(self[blob].data)
+                # difflib is too slow for huge files
+                if len(old_lines) + len(new_lines) < 50000:
+                    return carry_blame(old, base, old_lines, new_lines)
+                break
+            if pblob != blob:
+                break
+            base = parent
+        return self.full_blame(base, path)
+
+    def full_blame(self, commit, path):
+        contents = decode(self.git('blame', '-p', commit.hex, '--', path).stdout).split('\n')
         contents.pop(-1)
-        commits = {}
+        commits, index, lines = [], {}, []
         last_commit = None
-        lines = []
-        orig_line = line_now = 0
         for line in contents:
             if not last_commit:
-                last_commit, orig_line, line_now = line.split()[:3]
-                if last_commit not in commits:
-                    commits[last_commit] = {'hex': last_commit}
+                last_commit, orig_line = line.split()[:2]
+                if last_commit not in index:
+                    index[last_commit] = len(commits)
+                    commits.append([last_commit, None, None])
             elif line.startswith('\t'):
-                lines.append((line[1:], orig_line, line_now, commits[last_commit]))
+                lines.append([index[last_commit], int(orig_line)])
                 last_commit = None
-            elif line == 'boundary':
-                commits[last_commit]['previous'] = None
-            else:
-                key, val = line.split(None, 1)
-                commits[last_commit][key] = val
-        return lines
+            elif line.startswith('summary '):
+                commits[index[last_commit]][1] = line[8:]
+            elif line.startswith('committer-time '):
+                commits[index[last_commit]][2] = int(line[15:])
+        return {'commits': commits, 'lines': lines}
 
-    def grep(self, commit, path, query):
+    def grep(self, commit, path, query, deadline=None):
+        """Yield (filename, chunks) for files matching query, reading git
+           grep's output as it comes. Closing the generator stops git grep,
+           so reading only the first results is cheap. git grep is also
+           stopped at deadline, if given"""
         if hasattr(commit, 'hex'):
             commit = commit.hex
-        results = self.git('grep', '-n', '--full-name', '-z', '-I', '-C1', '--heading', '--break', query, commit, '--', path).stdout.strip()
-        if not results:
-            raise StopIteration
-        files = results.split('\n\n')
-        for file in files:
-            chunks = []
-            for chunk in [x.split('\n') for x in file.split('\n--\n')]:
-                chunks.append([line.split('\0') for line in chunk])
-            filename = chunks[0].pop(0)[0].split(':', 1)
-            yield filename, chunks
+        paths = [path or '.']
+        if self.trigram_index:
+            match = self.ref_index.lookup(commit)
+            candidates = self.trigram_index.candidates(match and not match[3] and match[2] or commit, path, query)
+            if candidates == []:
+                return
+            # Too many paths for a command line, the index isn't much use then anyway
+            if candidates and len(candidates) <= 1000:
+                paths = candidates
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(['git', '--literal-pathspecs', '--git-dir', self.path, 'grep', '-n', '--full-name', '-z', '-I', '-C1', '--heading',
+                                     '--break', '-e', query, commit, '--'] + paths, stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        timer = None
+        if deadline:
+            timer = threading.Timer(max(0, deadline - time.time()), proc.kill)
+            timer.start()
+        try:
+            filename = None
+            for line in iter(proc.stdout.readline, ''):
+                line = line.rstrip('\n')
+                if filename is None:
+                    filename, chunks = line.split('\0')[0].split(':', 1), [[]]
+                elif not line:
+                    # --break puts an empty line between files
+                    yield filename, chunks
+                    filename = None
+                elif line == '--':
+                    chunks.append([])
+                else:
+                    chunks[-1].append(line.split('\0'))
+            if filename is not None:
+                yield filename, chunks
+        finally:
+            if timer:
+                timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+    def open_blob(self, oid):
+        return BlobReader(self, oid)
 
     def git(self, *args):
         return shell.git('--git-dir', self.path, '--work-tree', self.workdir or '/nonexistent', *args)
 
+def blame_key(commit, path):
+    return 'blame_%s_%s.json' % (commit, hashlib.sha1(utf8(path)).hexdigest())
+
+def split_lines(data):
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop(-1)
+    return lines
+
+def carry_blame(old, commit, old_lines, new_lines):
+    """Blame of a changed file, given the blame of the previous version"""
+    commits, index, result = [], {}, []
+    def annotate(hex, summary, time, orig_line):
+        if hex not in index:
+            index[hex] = len(commits)
+            commits.append([hex, summary, time])
+        result.append([index[hex], orig_line])
+    summary = decode(commit.message.split('\n')[0])
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            for idx, orig_line in old['lines'][i1:i2]:
+                annotate(*(old['commits'][idx] + [orig_line]))
+        else:
+            for num in range(j1, j2):
+                annotate(commit.hex, summary, commit.committer.time, num + 1)
+    return {'commits': commits, 'lines': result}
+
+def format_date(timestamp, offset):
+    sign = offset < 0 and '-' or '+'
+    return time.strftime('%a, %d %b %Y %H:%M:%S ', time.gmtime(timestamp + offset * 60)) + '%s%02d%02d' % (sign, abs(offset) / 60, abs(offset) % 60)
+
+def format_patch(commit, stat, diff):
+    """Yield a patch like git format-patch makes in pieces: the header and
+       diffstat, then the patch of each file"""
+    subject, _, body = commit.message.partition('\n')
+    body = body.strip('\n')
+    ret = ['From %s Mon Sep 17 00:00:00 2001' % commit.hex,
+           'From: %s <%s>' % (commit.author.name, commit.author.email),
+           'Date: %s' % format_date(commit.author.time, commit.author.offset),
+           'Subject: [PATCH] %s' % subject, '']
+    if body:
+        ret.append(body)
+    ret.append('---')
+    width = max([len(utf8(file['new'])) for file in stat] + [0])
+    changes = max([file['+'] + file['-'] for file in stat] + [1])
+    for file in stat:
+        if file['binary']:
+            graph = 'Bin'
+        else:
+            scale = min(1.0, 50.0 / changes)
+            graph = '%d %s%s' % (file['+'] + file['-'], '+' * int(round(file['+'] * scale)), '-' * int(round(file['-'] * scale)))
+        ret.append(' %s | %s' % (utf8(file['new']).ljust(width), graph))
+    ret.append(' %d file%s changed, %d insertions(+), %d deletions(-)' % (len(stat), len(stat) != 1 and 's' or '',
+               sum([file['+'] for file in stat]), sum([file['-'] for file in stat])))
+    yield '\n'.join([utf8(line) for line in ret]) + '\n\n'
+    # Newer pygit2 has the text of each file's patch, older only of all of them
+    if stat and not hasattr(diff[0], 'text') and not hasattr(diff[0], 'patch'):
+        yield utf8(diff.patch)
+    else:
+        for patch in diff:
+            yield utf8(getattr(patch, 'text', None) or getattr(patch, 'patch', None) or '')
+    yield '-- \ngoblet\n\n'
+
 def get_tree(tree, path):
     for dir in path:
         if dir not in tree:
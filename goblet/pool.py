@@ -0,0 +1,45 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+import pygit2
+import threading
+from collections import OrderedDict
+from flask import current_app
+from goblet.monkey import refs_stamp
+
+class RepositoryPool(object):
+    """Per-worker LRU pool of open repository handles. A handle is reused as
+       long as the refs stamp of the repository hasn't changed, so warm
+       requests keep libgit2's object cache and skip reopening the odb."""
+    def __init__(self, size):
+        self.size = size
+        self.repos = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            repo = self.repos.pop(path, None)
+        if repo is not None:
+            stamp = refs_stamp(repo.path)
+            if stamp != repo.stamp:
+                repo = None
+        if repo is None:
+            repo = pygit2.Repository(path)
+            repo.stamp = refs_stamp(repo.path)
+        with self.lock:
+            self.repos[path] = repo
+            while len(self.repos) > self.size:
+                self.repos.popitem(last=False)
+        return repo
+
+    def clear(self):
+        with self.lock:
+            self.repos.clear()
+
+_pool = None
+def get_repository(path):
+    global _pool
+    if _pool is None:
+        _pool = RepositoryPool(current_app.config['REPO_POOL_SIZE'])
+    return _pool.get(path)
@@ -7,9 +7,11 @@ from jinja2 import Markup, escape
 import pygments
 import pygments.formatters
 import pygments.lexers
-from goblet.encoding import decode
+from goblet.encoding import decode, decode_blob, is_binary
+from goblet.cache import render_cache
 from whelk import shell
 
+import hashlib
 import re
 import markdown as markdown_
 import docutils.core
@@ -18,8 +20,14 @@ import time
 renderers = {}
 image_exts = ('.gif', '.png', '.bmp', '.tif', '.tiff', '.jpg', '.jpeg', '.ppm',
     '.pnm', '.pbm', '.pgm', '.webp', '.ico')
-
-def render(repo, ref, path, entry, plain=False, blame=False):
+# The output of these only depends on the blob and the renderer, so it is
+# cached. Images and binaries are cheap, blame output depends on the commit.
+cached_renderers = ('code', 'plain', 'markdown', 'rest', 'man')
+# Code bigger than this is rendered in windows of window_lines lines
+window_threshold = 256 * 1024
+window_lines = 1000
+
+def render(repo, ref, path, entry, plain=False, blame=False, line=None):
     renderer = detect_renderer(repo, entry)
     if plain:
         if renderer[0] in ('rest', 'markdown'):
@@ -33,7 +41,48 @@ def render(repo, ref, path, entry, plain=False, blame=False):
             renderer = ('code', pygments.lexers.get_lexer_by_name('groff'), None, True)
         elif renderer[0] == 'code':
             renderer = list(renderer[:2]) + [None, True]
-    return renderer[0], renderers[renderer[0]](repo, ref, path, entry, *renderer[1:])
+    kwargs = {}
+    if renderer[0] == 'code' and repo[entry.oid].size > window_threshold:
+        kwargs['start'] = window_start(line)
+    if blame or renderer[0] not in cached_renderers:
+        return renderer[0], renderers[renderer[0]](repo, ref, path, entry, *renderer[1:], **kwargs)
+    file = render_cache().compute(render_key(entry, renderer, kwargs.get('start', None)),
+               lambda: renderers[renderer[0]](repo, ref, path, entry, *renderer[1:], **kwargs).encode('utf-8'))
+    with open(file) as fd:
+        return renderer[0], Markup(fd.read().decode('utf-8'))
+
+def render_key(entry, renderer, start=None):
+    """Rendered blobs are identified by their content and how they were rendered"""
+    lexer = len(renderer) > 1 and renderer[1].__class__.__name__ or ''
+    return hashlib.sha1('%s %s %s %s %s' % (entry.hex, renderer[0], lexer, start, pygments.__version__)).hexdigest() + '.html'
+
+def window_start(line):
+    """First line of the window that contains line"""
+    return (max(line or 1, 1) - 1) // window_lines * window_lines + 1
+
+def window_tokens(tokens, start, count):
+    """The tokens of count lines, starting at line start. Lexing starts at the
+       top of the file, so the lexer is in the right state at the start of
+       the window. Tokens spanning multiple lines are split."""
+    line = 1
+    for ttype, value in tokens:
+        parts = value.split('\n')
+        for num, part in enumerate(parts):
+            if num:
+                if line >= start:
+                    yield ttype, '\n'
+                line += 1
+                if line >= start + count:
+                    return
+            if part and line >= start:
+                yield ttype, part
+
+def find_readme(tree):
+    readme = None
+    for entry in tree:
+        if re.match(r'^readme(?:.(?:txt|rst|md))?$', entry.name, flags=re.I):
+            readme = entry
+    return readme
 
 def detect_renderer(repo, entry):
     name = entry.name.lower()
@@ -81,7 +130,7 @@ def detect_renderer(repo, entry):
         if lex:
             return 'code', lex()
 
-    if '\0' in data:
+    if is_binary(data):
         return 'binary',
 
     return 'code', pygments.lexers.TextLexer(), data
@@ -96,47 +145,76 @@ def image(repo, ref, path, entry):
 
 @renderer
 def plain(repo, ref, path, entry):
-    data = escape(decode(repo[entry.oid].data))
+    data = escape(decode_blob(repo, entry.hex))
     data = re.sub(r'(https?://(?:[-a-zA-Z0-9\._~:/?#\[\]@!\'()*+,;=]+|&amp;)+)', Markup(r'<a href="\1">\1</a>'), data)
     return Markup(u"<pre>%s</pre>" % data)
 
+class BlameFormatter(pygments.formatters.html.HtmlFormatter):
+    """Prefixes each line with the commit that last changed it, and links
+       the line number to that line in that commit"""
+    lineno_re = re.compile(r'^(<a name="l-\d+"></a><span class="[^"]+">\s*)(\d+)')
+
+    def __init__(self, repo, path, blame, **options):
+        super(BlameFormatter, self).__init__(**options)
+        self.repo, self.path, self.blame = repo, path, blame
+
+    def wrap(self, source, *args):
+        return super(BlameFormatter, self).wrap(self.annotate(source), *args)
+
+    def annotate(self, source):
+        from goblet.views import blob_link
+        num, last = self.linenostart - 1, None
+        for t, line in source:
+            if t != 1 or num >= len(self.blame):
+                yield t, line
+                continue
+            orig_line, commit = self.blame[num]
+            num += 1
+            match = self.lineno_re.match(line)
+            if not match:
+                yield t, line
+                continue
+            link = blob_link(self.repo, commit['hex'], self.path)
+            rest = line[match.end():]
+            if last == commit['hex']:
+                yield t, '        %s<a href="%s#l-%s">%s</a>%s' % (match.group(1), link, orig_line, match.group(2), rest)
+                continue
+            last = commit['hex']
+            link2 = url_for('commit', repo=self.repo.name, ref=commit['hex'])
+            yield t, '<a href="%s" title="%s (%s)">%s</a> %s<a href="%s#l-%s">%s</a>%s' % (link2, escape(commit['summary']),
+                time.strftime('%Y-%m-%d', time.gmtime(int(commit['committer-time']))),
+                commit['hex'][:7], match.group(1), link, orig_line, match.group(2), rest)
+
+window_html = Markup('<div class="window" data-start="%d" data-end="%d" data-lines="%d">%s</div>')
 @renderer
-def code(repo, ref, path, entry, lexer, data=None, blame=False):
-    from goblet.views import blob_link
+def code(repo, ref, path, entry, lexer, data=None, blame=False, start=None):
     try:
-        data = decode(data or repo[entry.oid].data)
+        data = decode_blob(repo, entry.hex, data)
     except:
         data = '(Binary data)'
-    formatter = pygments.formatters.html.HtmlFormatter(linenos='inline', linenospecial=10, encoding='utf-8', anchorlinenos=True, lineanchors='l')
-    html = Markup(pygments.highlight(data, lexer, formatter).decode('utf-8'))
+    options = dict(linenos='inline', linenospecial=10, encoding='utf-8', anchorlinenos=True, lineanchors='l', linenostart=start or 1)
     if blame:
         blame = repo.blame(ref, path)
         if not blame:
             return
-        blame.append(None)
-        def replace(match):
-            line = int(match.group(2)) - 1
-            _, orig_line, _, commit = blame[line]
-            link = blob_link(repo, commit['hex'], path)
-            if blame[-1] == commit['hex']:
-                return Markup('        %s<a href="%s#l-%s">%s</a>' % (match.group(1), link, orig_line, match.group(2)))
-            link2 = url_for('commit', repo=repo.name, ref=commit['hex'])
-            blame[-1] = commit['hex']
-            return Markup('<a href="%s" title="%s (%s)">%s</a> %s<a href="%s#l-%s">%s</a>' % (link2, commit['summary'],
-                time.strftime('%Y-%m-%d', time.gmtime(int(commit['committer-time']))),
-                commit['hex'][:7], match.group(1), link, orig_line, match.group(2)))
-        html = re.sub(r'(<a name="l-(\d+)"></a><span class="[^"]+">\s*)(\d+)', replace, html)
-    return html
+        formatter = BlameFormatter(repo, path, blame, **options)
+    else:
+        formatter = pygments.formatters.html.HtmlFormatter(**options)
+    if not start:
+        return Markup(pygments.highlight(data, lexer, formatter).decode('utf-8'))
+    lines = data.count('\n') + (not data.endswith('\n'))
+    html = pygments.format(window_tokens(lexer.get_tokens(data), start, window_lines), formatter).decode('utf-8')
+    return window_html % (start, min(lines, start + window_lines - 1), lines, Markup(html))
 
 add_plain_link = Markup('''<script type="text/javascript">add_plain_link()</script>''')
 @renderer
 def markdown(repo, ref, path, entry):
-    data = decode(repo[entry.oid].data)
+    data = decode_blob(repo, entry.hex)
     return Markup(markdown_.Markdown(safe_mode="escape").convert(data)) + add_plain_link
 
 @renderer
 def rest(repo, ref, path, entry):
-    data = decode(repo[entry.oid].data)
+    data = decode_blob(repo, entry.hex)
     settings = {
         'file_insertion_enabled': False,
         'raw_enabled': False,
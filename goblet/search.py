@@ -0,0 +1,70 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+from flask import current_app
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from goblet.catalog import get_catalog
+import pygit2
+import Queue
+import time
+
+SearchResult = namedtuple('SearchResult', ('name', 'ref', 'results', 'more', 'error'))
+
+_pool = None
+def search_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(current_app.config['SEARCH_WORKERS'])
+    return _pool
+
+def search_repository(args):
+    """Grep the default branch of a repository. Runs in a worker thread, with
+       its own repository handle"""
+    app, name, path, query, deadline, limit = args
+    if time.time() > deadline:
+        return None
+    with app.app_context():
+        try:
+            repo = pygit2.Repository(path)
+            ref = repo.head.target.hex
+            results = []
+            grep = repo.grep(ref, '', query, deadline=deadline)
+            for result in grep:
+                results.append(result)
+                if len(results) > limit:
+                    break
+            grep.close()
+            error = time.time() > deadline and "Search timed out" or None
+            return SearchResult(name, ref, results[:limit], len(results) > limit, error)
+        except Exception, e:
+            return SearchResult(name, None, [], False, str(e))
+
+def search_all(query, limit):
+    """Search the default branches of all repositories, one worker per
+       repository. Yields a SearchResult per repository as they finish, until
+       SEARCH_TIMEOUT has passed"""
+    config = current_app.config
+    deadline = time.time() + config['SEARCH_TIMEOUT']
+    app = current_app._get_current_object()
+    todo = [(app, entry['name'], entry['path'], query, deadline, limit) for entry in get_catalog().refresh() if entry['head']]
+    todo.reverse()
+    done = Queue.Queue()
+    pending = 0
+    while todo or pending:
+        # Only queue as many repositories as there are workers, so nothing is
+        # left behind in the shared pool when the deadline passes
+        while todo and pending < config['SEARCH_WORKERS'] and time.time() < deadline:
+            search_pool().apply_async(search_repository, (todo.pop(),), callback=done.put)
+            pending += 1
+        if not pending:
+            return
+        try:
+            # Workers kill git grep at the deadline, give them a moment to report
+            result = done.get(timeout=max(0, deadline - time.time()) + 1)
+        except Queue.Empty:
+            return
+        pending -= 1
+        if result:
+            yield result
@@ -0,0 +1,175 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+from distutils.spawn import find_executable
+from flask import current_app
+from goblet.cache import due, evict
+import fcntl
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+def compressor(*candidates):
+    """The first of several (parallel) compressors that is installed"""
+    for argv in candidates:
+        if find_executable(argv[0]):
+            return argv
+    return candidates[-1]
+
+snapshot_formats = {
+    'zip': ('zip', None,                                                     'zip'    ),
+    'xz':  ('tar', ['xz', '-T0', '-c'],                                      'tar.xz' ),
+    'gz':  ('tar', compressor(['pigz', '-9', '-c'], ['gzip', '-9', '-c']),    'tar.gz' ),
+    'bz2': ('tar', compressor(['pbzip2', '-9', '-c'], ['bzip2', '-9', '-c']), 'tar.bz2'),
+}
+if find_executable('zstd'):
+    snapshot_formats['zst'] = ('tar', ['zstd', '-3', '-T0', '-q', '-c'], 'tar.zst')
+
+chunk_size = 65536
+snapshot_re = re.compile(r'\.(zip|tar\.(xz|gz|bz2|zst))$')
+# The describe suffix of snapshots of commits that aren't tagged
+untagged_re = re.compile(r'-g[0-9a-f]{7}\.(zip|tar\.)')
+
+def snapshot_name(repo, ref, format):
+    format, compressor, ext = snapshot_formats[format]
+    desc = repo.describe(ref.hex).replace('/', '-')
+    return os.path.join(current_app.config['CACHE_ROOT'], '%s-%s.%s' % (repo.name.replace('/', '-'), desc, ext))
+
+def is_snapshot(path):
+    return bool(snapshot_re.search(path))
+
+def is_release(path):
+    return not untagged_re.search(os.path.basename(path))
+
+def evict_snapshots():
+    """Keep the snapshots in CACHE_ROOT within SNAPSHOT_CACHE_SIZE bytes by
+       removing the least recently served ones. Snapshots of tags are kept."""
+    config = current_app.config
+    if not config['SNAPSHOT_CACHE_SIZE']:
+        return 0
+    if not due(os.path.join(config['CACHE_ROOT'], '.snapshots-evicted'), config['CACHE_EVICT_INTERVAL']):
+        return 0
+    return evict([config['CACHE_ROOT']], config['SNAPSHOT_CACHE_SIZE'], pinned=is_release, match=is_snapshot)
+
+def snapshot(repo, ref, format):
+    """Returns (filename, generator). If the snapshot exists already, the
+       generator is None. Otherwise it yields the snapshot while it is being
+       written to the cache, either by generating it or by following a build
+       that is already in progress in another request"""
+    cache_dir = current_app.config['CACHE_ROOT']
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    evict_snapshots()
+    filename = snapshot_name(repo, ref, format)
+    try:
+        # The mtime is the last time it was served
+        os.utime(filename, None)
+        return filename, None
+    except OSError:
+        pass
+    format, compressor, ext = snapshot_formats[format]
+    prefix = os.path.basename(filename)[:-len(ext)-1] + '/'
+    argv = ['git', '--git-dir', repo.path, 'archive', '--format', format, '--prefix', prefix, ref.hex]
+    return filename, stream(filename, argv, compressor)
+
+def make_snapshot(repo, ref, format):
+    """Create a snapshot in CACHE_ROOT if it doesn't exist yet and return its
+       filename"""
+    filename, generator = snapshot(repo, ref, format)
+    for chunk in generator or []:
+        pass
+    return filename
+
+def stream(filename, argv, compressor):
+    dirname, basename = os.path.split(filename)
+    part = os.path.join(dirname, '.%s.part' % basename)
+    lockfile = os.path.join(dirname, '.%s.lock' % basename)
+    with open(lockfile, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Someone else is building it
+            for chunk in follow(filename, part, lock):
+                yield chunk
+            return
+        try:
+            if os.path.exists(filename):
+                for chunk in follow(filename, part, lock):
+                    yield chunk
+                return
+            for chunk in build(filename, part, argv, compressor):
+                yield chunk
+        finally:
+            # Once the snapshot exists the lock isn't needed anymore. Anyone
+            # still waiting for it finds the snapshot when they get it.
+            if os.path.exists(filename):
+                try:
+                    os.unlink(lockfile)
+                except OSError:
+                    pass
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def build(filename, part, argv, compressor):
+    """Run git archive and the compressor in a pipeline, write the output to
+       the cache and yield it at the same time"""
+    stderr = tempfile.TemporaryFile()
+    procs = [subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=stderr, close_fds=True)]
+    if compressor:
+        procs.append(subprocess.Popen(compressor, stdin=procs[0].stdout, stdout=subprocess.PIPE, stderr=stderr, close_fds=True))
+        procs[0].stdout.close()
+    out = open(part, 'wb')
+    done = False
+    try:
+        for chunk in iter(lambda: procs[-1].stdout.read(chunk_size), ''):
+            out.write(chunk)
+            yield chunk
+        done = True
+    finally:
+        if not done:
+            # The client went away. Finish the build anyway, others may be
+            # following it and the result is worth caching.
+            for chunk in iter(lambda: procs[-1].stdout.read(chunk_size), ''):
+                out.write(chunk)
+        out.close()
+        if [proc.wait() for proc in procs] != [0] * len(procs):
+            os.unlink(part)
+            stderr.seek(0)
+            raise RuntimeError(stderr.read())
+        os.rename(part, filename)
+
+def follow(filename, part, lock):
+    """Yield a snapshot that another request is building"""
+    for _ in range(600):
+        try:
+            fd = open(part, 'rb')
+            break
+        except IOError:
+            if os.path.exists(filename):
+                fd = open(filename, 'rb')
+                break
+            time.sleep(0.1)
+    else:
+        raise RuntimeError("Timeout waiting for snapshot %s" % filename)
+    with fd:
+        while True:
+            chunk = fd.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            # At the end of what's written so far. If we can get the lock, the
+            # builder is done and the file is complete, or it failed.
+            try:
+                fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                time.sleep(0.1)
+                continue
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            chunk = fd.read()
+            if chunk:
+                yield chunk
+            if not os.path.exists(filename):
+                raise RuntimeError("Building snapshot %s failed" % filename)
+            return
@@ -31,6 +31,51 @@ function init_clone_urls() {
     });
     $('#cloneurl').attr('value', $('.urllink').first().children('span').html());
 }
+function init_windows() {
+    // Big files are rendered a window at a time, line anchors outside the
+    // first window need the right window from the server
+    var anchor = window.location.hash.match(/^#l-(\d+)$/);
+    if(anchor && $('.window').length && !$('a[name="l-' + anchor[1] + '"]').length) {
+        window.location = window.location.pathname + '?line=' + anchor[1] + window.location.hash;
+        return;
+    }
+    $('.window').each(function(index, elt) {
+        add_window_links($(elt));
+    });
+}
+function add_window_links(win) {
+    if(win.data('start') > 1 && !win.prev('.window').length) {
+        win.before($('<a class="window-more" href="#">Show lines before ' + win.data('start') + '</a>').click(function() {
+            load_window($(this), win.data('start') - 1);
+            return false;
+        }));
+    }
+    if(win.data('end') < win.data('lines') && !win.next('.window').length) {
+        win.after($('<a class="window-more" href="#">Show lines after ' + win.data('end') + '</a>').click(function() {
+            load_window($(this), win.data('end') + 1);
+            return false;
+        }));
+    }
+}
+function load_window(link, line) {
+    var url = '/j/' + repo + '/blobwindow/' + ref + '/' + path + '?line=' + line + (action == 'blame' ? '&blame=1' : '');
+    link.html('Loading...');
+    $.getJSON(url, success=function(data) {
+        var win = $(data.html);
+        link.replaceWith(win);
+        add_window_links(win);
+    });
+}
+function init_collapsed_diffs() {
+    $('.collapsed .load-diff').click(function() {
+        var blob = $(this).closest('.collapsed');
+        $(this).html('Loading...');
+        $.getJSON(blob.data('url'), success=function(data) {
+            blob.replaceWith(data.html);
+        });
+        return false;
+    });
+}
 function add_plain_link() {
     $('.actions').prepend('<a href="' + window.location + '?plain=1">plain</a> | ')
 }
@@ -2,19 +2,25 @@
 # Copyright (C) 2012-2014 Dennis Kaarsemaker
 # See the LICENSE file for licensing details
 
-from flask import render_template, current_app, redirect, url_for, request, send_file
+from flask import render_template, current_app, redirect, url_for, request, send_file, Response, stream_with_context
 from flask.views import View
-from goblet.encoding import decode
-from goblet.render import render
+from goblet.encoding import decode, detect, is_binary
+from goblet.render import render, find_readme
+from goblet.pool import get_repository
+from goblet.catalog import get_catalog
+from goblet.snapshot import snapshot, snapshot_formats
+from goblet.search import search_all
+from goblet.cache import repo_cache
 import os
 import glob
+import json
 import pygit2
-import re
 import stat
-import chardet
 import mimetypes
+import hashlib
+import re
+import itertools
 from collections import namedtuple
-from whelk import shell
 
 class NotFound(Exception):
     pass
@@ -28,45 +34,81 @@ class TemplateView(View):
 class IndexView(TemplateView):
     template_name = 'repo_index.html'
 
-    def list_repos(self, root, level):
-        for file in os.listdir(root):
-            path = os.path.join(root, file)
-            if not os.path.isdir(path) or not os.access(path, os.R_OK):
-                continue
-            if path.endswith('.git'):
-                yield path
-            elif os.path.exists(os.path.join(path, '.git')):
-                yield os.path.join(path, '.git')
-            elif level > 0:
-                for path in self.list_repos(path, level-1):
-                    yield path
-
     def dispatch_request(self):
-        root = current_app.config['REPO_ROOT']
-        depth = current_app.config['MAX_SEARCH_DEPTH']
-        repos = []
-        for repo in sorted(self.list_repos(root, depth),key=lambda x:x.lower()):
-            try:
-                repos.append(pygit2.Repository(repo))
-            except KeyError:
-                # Something was unreadable
-                pass
+        repos = get_catalog().refresh()
         for keyword in request.args.get('q', '').lower().split():
             keyword = keyword.strip()
             if keyword:
-                repos = [repo for repo in repos if keyword in repo.name.lower() or keyword in repo.description.lower()]
+                repos = [repo for repo in repos if keyword in repo['name'].lower() or keyword in repo['description'].lower()]
         return self.render({'repos': repos})
 
+class SearchView(TemplateView):
+    template_name = 'search_all.html'
+    results_per_repo = 10
+
+    def dispatch_request(self):
+        query = request.args.get('q', '').strip()
+        context = {'query': query, 'results': query and search_all(query, self.results_per_repo) or []}
+        current_app.update_template_context(context)
+        # Results are sent per repository, as soon as they're there
+        template = current_app.jinja_env.get_template(self.template_name)
+        return Response(stream_with_context(template.stream(context)))
+
+sha_re = re.compile(r'^[0-9a-f]{40}$')
+
 class RepoBaseView(TemplateView):
     template_name = None
+    # Pages also show branches, tags and versions, so only views that send
+    # nothing but the content of a commit can be cached forever
+    content_only = False
     def dispatch_request(self, repo, *args, **kwargs):
         root = current_app.config['REPO_ROOT']
         try:
-            repo = pygit2.Repository(os.path.join(root, repo))
+            repo = get_repository(os.path.join(root, repo))
         except KeyError:
             return "No such repo", 404
         if not repo.head:
             return self.nocommits({'repo': repo})
+        # Answer conditional requests before doing any real work
+        # RawView needs the ETag for If-Range
+        self.etag, immutable = self.validator(repo, kwargs)
+        if self.etag in request.if_none_match:
+            return self.cache_headers(Response(status=304), self.etag, immutable)
+        ret = current_app.make_response(self.handle_repo_request(repo, *args, **kwargs))
+        if ret.status_code in (200, 206):
+            self.cache_headers(ret, self.etag, immutable)
+        return ret
+
+    def url_ref(self, kwargs):
+        """The ref or commit the url is for, possibly followed by a path"""
+        return kwargs.get('ref', None) or kwargs.get('path', None)
+
+    def validator(self, repo, kwargs):
+        """ETag for the url, and whether its content can never change. The
+           content of a full commit sha is immutable, anything else changes
+           with the commit its ref resolves to and with any ref update."""
+        path = self.url_ref(kwargs) or ''
+        match = path and repo.ref_index.lookup(path)
+        sha = path.split('/')[0]
+        if not match and sha_re.match(sha) and sha in repo:
+            if self.content_only:
+                ids, immutable = [sha], True
+            else:
+                ids, immutable = [sha, repr(repo.refs_stamp())], False
+        else:
+            ids, immutable = [match and match[2] or repo.head.target.hex, repr(repo.refs_stamp())], False
+        etag = hashlib.sha1(' '.join([request.full_path.encode('utf-8')] + ids)).hexdigest()
+        return etag, immutable
+
+    def cache_headers(self, response, etag, immutable):
+        response.set_etag(etag)
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=%d' % current_app.config['CACHE_MAX_AGE']
+        return response
+
+    def handle_repo_request(self, repo, *args, **kwargs):
         data = {'repo': repo, 'action': request.endpoint}
         try:
             ret = self.handle_request(repo, *args, **kwargs)
@@ -92,70 +134,47 @@ class TagsView(RepoBaseView):
     tags_per_page = 50
 
     def handle_request(self, repo):
-        tags = [repo.lookup_reference(x) for x in repo.listall_references() if x.startswith('refs/tags')]
-        tags = [(tag.name[10:], repo[tag.target.hex]) for tag in tags]
-        # Annotated tags vs normal tags
-        # Result is list of (name, tag or None, commit)
-        tags = [(name, hasattr(tag, 'target') and tag or None, hasattr(tag, 'target') and repo[tag.target] or tag) for name, tag in tags]
-        # Filter out non-commits
-        tags = [x for x in tags if x[2].type == pygit2.GIT_OBJ_COMMIT]
-        # Sort by tag-time or commit-time
-        tags.sort(reverse=True, key=lambda t: t[1] and t[1].tagger and t[1].tagger.time or t[2].commit_time)
-        for keyword in request.args.get('q', '').lower().split():
-            keyword = keyword.strip()
-            if keyword:
-                tags = [tag for tag in tags if keyword in tag[0] or
-                        (tag[1] and keyword in tag[1].message) or
-                        ((tag[1] and tag[1].tagger) and (keyword in tag[1].tagger.name or keyword in tag[1].tagger.email))]
-
         page = 1
         try:
             page = int(request.args['page'])
         except (KeyError, ValueError):
             pass
         page = max(1,page)
+        keywords = [x.strip() for x in request.args.get('q', '').lower().split() if x.strip()]
+        start = (page-1) * self.tags_per_page
+        total, tags = repo.tag_index.page(keywords, start, self.tags_per_page)
+
         next_page = prev_page = None
-        total = len(tags)
         if page > 1:
             prev_page = page - 1
         if total > self.tags_per_page * page:
             next_page = page + 1
 
-        start = (page-1) * self.tags_per_page
         end = min(start + 50, total)
-        return {'tags': tags[start:end], 'start': start+1, 'end': end, 'total': total, 'prev_page': prev_page, 'next_page': next_page}
+        return {'tags': tags, 'start': start+1, 'end': end, 'total': total, 'prev_page': prev_page, 'next_page': next_page}
 
 # Repo, path and blob
 
 class PathView(RepoBaseView):
     def split_ref(self, repo, path, expects_file=False):
         file = None
-        # First extract branch, which can contain slashes
-        for ref in sorted(repo.branches(), key = lambda x: -len(x)):
-            if path.startswith(ref):
-                path = path.replace(ref, '')[1:]
-                tree = repo[repo.lookup_reference('refs/heads/%s' % ref).target.hex].tree
-                break
+        # First extract branch or tag, which can contain slashes
+        match = repo.ref_index.lookup(path)
+        if match:
+            kind, ref, hex, path = match
+            if kind == 'tags':
+                ref = hex
+            tree = repo[hex].tree
         else:
-            # OK, maybe a tag?
-            for ref in sorted(repo.tags(), key = lambda x: -len(x)):
-                if path.startswith(ref):
-                    path = path.replace(ref, '')[1:]
-                    ref = repo.lookup_reference('refs/tags/%s' % ref).target.hex
-                    if repo[ref].type == pygit2.GIT_OBJ_TAG:
-                        ref = repo[repo[ref].target].hex
-                    tree = repo[ref].tree
-                    break
+            # Or a commit
+            if '/' in path:
+                ref, path = path.split('/', 1)
             else:
-                # Or a commit
-                if '/' in path:
-                    ref, path = path.split('/', 1)
-                else:
-                    ref, path = path, ''
-                try:
-                    tree = repo[ref].tree
-                except (KeyError, ValueError):
-                    raise NotFound("No such commit/ref")
+                ref, path = path, ''
+            try:
+                tree = repo[ref].tree
+            except (KeyError, ValueError):
+                raise NotFound("No such commit/ref")
 
         # Remainder is path
         path_ = path.split('/')
@@ -164,10 +183,11 @@ class PathView(RepoBaseView):
                 raise NotFound("No such file")
             entry = tree[path_.pop(0)]
 
-            if expects_file and not path_:
-                if not stat.S_ISREG(entry.filemode):
-                    raise NotFound("Not a file")
+            # expects_file=None accepts both files and folders
+            if expects_file is not False and not path_ and stat.S_ISREG(entry.filemode):
                 file = entry
+            elif expects_file and not path_:
+                raise NotFound("Not a file")
             elif not stat.S_ISDIR(entry.filemode):
                 raise NotFound("Not a folder")
             else:
@@ -189,7 +209,6 @@ class TreeView(PathView):
 
     def git_grep(self, repo, ref, path):
         self.template_name = 'search.html'
-        results = list(repo.grep(ref, path, request.args['q']))
 
         page = 1
         try:
@@ -197,17 +216,23 @@ class TreeView(PathView):
         except (KeyError, ValueError):
             pass
         page = max(1,page)
+        start = (page-1) * self.results_per_page
+
+        # Only read as far as needed to know whether there's a next page
+        grep = repo.grep(ref, path, request.args['q'])
+        results = list(itertools.islice(grep, start, start + self.results_per_page + 1))
+        grep.close()
+
         next_page = prev_page = None
-        total = len(results)
         if page > 1:
             prev_page = page - 1
-        if total > self.results_per_page * page:
+        if len(results) > self.results_per_page:
             next_page = page + 1
+        results = results[:self.results_per_page]
+        end = start + len(results)
 
-        start = (page-1) * self.results_per_page
-        end = min(start + 50, total)
-
-        return {'results': results[start:end], 'start': start+1, 'end': end, 'total': total,
+        # The total is only known once the last page is reached
+        return {'results': results, 'start': start+1, 'end': end, 'total': end, 'more': bool(next_page),
                 'ref': ref, 'path': path, 'next_page': next_page, 'prev_page': prev_page}
 
 class RepoView(TreeView):
@@ -216,11 +241,10 @@ class RepoView(TreeView):
         if 'q' in request.args:
             ref = repo.ref_for_commit(repo.head.target.hex)
             return redirect(url_for('tree', repo=repo.name, path=ref) + '?q=' + request.args['q'])
-        readme = renderer = rendered_file = None
-        for file in tree:
-            if re.match(r'^readme(?:.(?:txt|rst|md))?$', file.name, flags=re.I):
-                readme = file
-                renderer, rendered_file = render(repo, repo.head, '', readme)
+        renderer = rendered_file = None
+        readme = find_readme(tree)
+        if readme:
+            renderer, rendered_file = render(repo, repo.head, '', readme)
         return {'readme': readme, 'tree': tree, 'ref': repo.ref_for_commit(repo.head.target.hex),
                 'path': '', 'show_clone_urls': True, 'renderer': renderer, 'rendered_file': rendered_file}
 
@@ -230,7 +254,8 @@ class BlobView(PathView):
     def handle_request(self, repo, path):
         ref, path, tree, file = self.split_ref(repo, path, expects_file=True)
         folder = '/' in path and path[:path.rfind('/')] or None
-        renderer, rendered_file  = render(repo, ref, path, file, blame=request.endpoint == 'blame', plain=request.args.get('plain') == '1')
+        renderer, rendered_file  = render(repo, ref, path, file, blame=request.endpoint == 'blame', plain=request.args.get('plain') == '1',
+                                          line=request.args.get('line', None, type=int))
         # For empty blames, a redirect to the history is better
         if rendered_file is None:
             return redirect(url_for('history', repo=repo.name, path='%s/%s' % (ref, path)))
@@ -238,29 +263,47 @@ class BlobView(PathView):
 
 class RawView(PathView):
     template = None
+    content_only = True
     def handle_request(self, repo, path):
         ref, path, tree, file = self.split_ref(repo, path, expects_file=True)
         if not ref:
             raise NotFound("No such file")
 
         # Try to detect the mimetype
-        mimetype, encoding = mimetypes.guess_type(file.name)
-        data = repo[file.hex].data
+        mimetype, compression = mimetypes.guess_type(file.name)
+        blob = repo.open_blob(file.hex)
+        sample = blob.sample
+        # Compressed files are sent as they are
+        if compression:
+            mimetype = 'application/octet-stream'
         # shbang'ed: text/plain will do
-        if not mimetype and data[:2] == '#!':
+        if not mimetype and sample[:2] == '#!':
             mimetype = 'text/plain'
-        # For text mimetypes, guess an encoding
         if not mimetype:
-            if '\0' in data:
+            if is_binary(sample):
                 mimetype = 'application/octet-stream'
             else:
                 mimetype = 'text/plain'
-        if mimetype.startswith('text/') and not encoding:
-            encoding = chardet.detect(data)['encoding']
-        headers = {'Content-Type': mimetype}
-        if encoding:
-            headers['Content-Encoding'] = encoding
-        return (data, 200, headers)
+        # For text mimetypes, guess an encoding from the start of the file
+        if mimetype.startswith('text/'):
+            encoding = detect(sample)
+            if encoding:
+                mimetype += '; charset=%s' % encoding
+
+        status = 200
+        headers = {'Content-Type': mimetype, 'Accept-Ranges': 'bytes'}
+        # Only a single range is supported, anything else gets the whole file
+        if request.range and ('If-Range' not in request.headers or request.if_range.etag == self.etag):
+            range = request.range.range_for_length(blob.size)
+            if range:
+                blob.start, blob.end = range
+                status = 206
+                headers['Content-Range'] = request.range.make_content_range(blob.size).to_header()
+            elif request.range.units == 'bytes' and len(request.range.ranges) == 1:
+                blob.close()
+                return Response('Requested range not satisfiable', 416, {'Content-Range': 'bytes */%d' % blob.size})
+        headers['Content-Length'] = str(blob.end - blob.start)
+        return Response(blob, status, headers, direct_passthrough=True)
 
 # Log, snapshot, commit and diff
 
@@ -286,12 +329,10 @@ class RefView(RepoBaseView):
         except (KeyError, ValueError):
             raise NotFound("No such commit/ref")
 
-class LogView(RefView):
-    template_name = 'log.html'
-    commits_per_page = 50
-
-    def handle_request(self, repo, ref=None):
-        ref = self.lookup_ref(repo, ref)
+    def log_page(self, repo, ref, **kwargs):
+        """A page of history. Without a cursor the walk skips over all earlier
+           pages, with one it resumes where the previous page stopped. Searches
+           are answered from the message index if possible."""
         page = 1
         try:
             page = int(request.args['page'])
@@ -302,93 +343,150 @@ class LogView(RefView):
         if page > 1:
             prev_page = page - 1
 
-        log = list(repo.get_commits(ref, skip=self.commits_per_page * (page-1), count=self.commits_per_page, search=request.args.get('q', '')))
-        if log and log[-1].parents:
+        pending = set()
+        hits = kwargs.get('search') and repo.message_index.search(ref.hex, kwargs['search'])
+        # Expired cursors fall back to skipping
+        cursor = 'after' in request.args and decode_cursor(repo, request.args['after'])
+        prev_cursor = None
+        if hits:
+            # Indexed search results are paged by number, no cursor needed
+            start = self.commits_per_page * (page-1)
+            log = list(itertools.islice(hits, start, start + self.commits_per_page + 1))
+            if len(log) > self.commits_per_page:
+                pending.add(log.pop(-1).hex)
+        elif cursor:
+            tips, prev_cursor = cursor
+            try:
+                log = list(repo.get_commits(ref, skip=0, count=self.commits_per_page, cursor=tips, pending=pending, **kwargs))
+            except (KeyError, ValueError):
+                raise NotFound("No such commit/ref")
+        else:
+            log = list(repo.get_commits(ref, skip=self.commits_per_page * (page-1), count=self.commits_per_page, pending=pending, **kwargs))
+        next_cursor = None
+        if log and pending:
             next_page = page + 1
+            if not hits:
+                next_cursor = encode_cursor(repo, pending, cursor and request.args['after'] or None)
         shas = [x.hex for x in log]
-        return {'ref': repo.ref_for_commit(ref), 'log': log, 'shas': shas, 'refs': repo.reverse_refs, 'next_page': next_page, 'prev_page': prev_page}
+        return {'ref': repo.ref_for_commit(ref), 'log': log, 'shas': shas, 'refs': repo.reverse_refs, 'versions': repo.versions(log),
+                'next_page': next_page, 'next_cursor': next_cursor, 'prev_page': prev_page, 'prev_cursor': prev_cursor}
+
+def encode_cursor(repo, shas, prev=None):
+    """The commits a walk continues with can be many, so urls only carry a
+       token for them. The commits are kept in the repository cache, together
+       with the token for the page before, so paging back is cheap too"""
+    data = json.dumps({'tips': sorted(shas), 'prev': prev})
+    token = hashlib.sha1(data).hexdigest()
+    cache = repo_cache(repo)
+    if not cache.get('cursor_%s.json' % token):
+        cache.put('cursor_%s.json' % token, data)
+    return token
+
+def decode_cursor(repo, token):
+    """(tips, previous token) for a cursor token, or None if it expired"""
+    if not sha_re.match(token):
+        raise NotFound("Invalid cursor")
+    path = repo_cache(repo).get('cursor_%s.json' % token)
+    if not path:
+        return None
+    with open(path) as fd:
+        data = json.load(fd)
+    return [str(sha) for sha in data['tips']], data['prev'] and str(data['prev'])
+
+class LogView(RefView):
+    template_name = 'log.html'
+    commits_per_page = 50
+
+    def handle_request(self, repo, ref=None):
+        ref = self.lookup_ref(repo, ref)
+        return self.log_page(repo, ref, search=request.args.get('q', ''))
 
 class HistoryView(PathView,RefView):
     template_name = 'log.html'
     commits_per_page = 50
 
     def handle_request(self, repo, path):
-        ref, path, tree, file = self.split_ref(repo, path, expects_file=True)
+        ref, path, tree, file = self.split_ref(repo, path, expects_file=None)
         ref = self.lookup_ref(repo, ref)
-        page = 1
-        try:
-            page = int(request.args['page'])
-        except (KeyError, ValueError):
-            pass
-        page = max(1,page)
-        next_page = prev_page = None
-        if page > 1:
-            prev_page = page - 1
+        return self.log_page(repo, ref, file=path)
 
-        log = list(repo.get_commits(ref, skip=self.commits_per_page * (page-1), count=self.commits_per_page, file=path))
-        if log and log[-1].parents and len(log) == self.commits_per_page:
-            next_page = page + 1
-        shas = [x.hex for x in log]
-        return {'ref': repo.ref_for_commit(ref), 'log': log, 'shas': shas, 'refs': repo.reverse_refs, 'next_page': next_page, 'prev_page': prev_page}
 
-
-snapshot_formats = {
-    'zip': ('zip', None,            'zip'    ),
-    'xz':  ('tar', ['xz'],          'tar.xz' ),
-    'gz':  ('tar', ['gzip',  '-9'], 'tar.gz' ),
-    'bz2': ('tar', ['bzip2', '-9'], 'tar.bz2'),
-}
 class SnapshotView(RefView):
+    content_only = True
     def handle_request(self, repo, ref, format):
         ref = self.lookup_ref(repo, ref)
-        format, compressor, ext = snapshot_formats.get(format, (None, None))
-        if not format:
+        if format not in snapshot_formats:
             raise NotFound("No such snapshot format")
-        cache_dir = current_app.config['CACHE_ROOT']
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-
-        desc = repo.describe(ref.hex).replace('/', '-')
-        filename_compressed = os.path.join(cache_dir, '%s-%s.%s' % (repo.name, desc, ext))
-        filename_uncompressed = os.path.join(cache_dir, '%s-%s.%s' % (repo.name, desc, format))
-        if not os.path.exists(filename_compressed):
-            ret = repo.git('archive', '--format', format, '--prefix', '%s-%s/' % (repo.name, desc), '--output', filename_uncompressed, ref.hex)
-            if ret.returncode != 0:
-                raise RuntimeError(ret.stderr)
-            if compressor:
-                compressor = compressor[:]
-                compressor.append(filename_uncompressed)
-                ret = getattr(shell, compressor[0])(*compressor[1:])
-                if ret.returncode != 0:
-                    raise RuntimeError(ret.stderr)
-        return send_file(filename_compressed, attachment_filename=os.path.basename(filename_compressed), as_attachment=True, cache_timeout=86400)
+        filename, generator = snapshot(repo, ref, format)
+        if not generator:
+            return send_file(filename, attachment_filename=os.path.basename(filename), as_attachment=True, cache_timeout=86400)
+        # Still being built, send it while it's being generated
+        return Response(generator, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=%s' % os.path.basename(filename)})
 
 class CommitView(RefView):
     template_name = 'commit.html'
+    # Diffs of files beyond these limits are loaded on demand
+    max_files = 25
+    max_file_lines = 500
 
     def handle_request(self, repo, ref=None):
         ref = self.lookup_ref(repo, ref)
         stat = {}
-        if not ref.parents:
-            diff = ref.tree.diff_to_tree(swap=True)
-        else:
-            diff = ref.parents[0].tree.diff_to_tree(ref.tree)
-        for file in diff:
-            s = stat[file.new_file_path] = {'-': 0, '+': 0}
-            for hunk in file.hunks:
-                hs = [x[0] for x in hunk.lines]
-                s['-'] += hs.count('-')
-                s['+'] += hs.count('+')
-                s['%'] = int(100.0 * s['+'] / (s['-']+s['+']))
-        stat[None] = {'-': sum([x['-'] for x in stat.values()]), '+': sum([x['+'] for x in stat.values()])}
-        return {'commit': ref, 'diff': diff, 'stat': stat}
+        files = repo.diff_stat(ref)
+        collapsed = set()
+        lines = 0
+        for num, file in enumerate(files):
+            if file['+'] + file['-']:
+                file['%'] = int(100.0 * file['+'] / (file['-']+file['+']))
+            if num >= self.max_files or file['+'] + file['-'] > self.max_file_lines or lines > self.max_file_lines * 4:
+                collapsed.add(num)
+            else:
+                lines += file['+'] + file['-']
+        stat[None] = {'-': sum([x['-'] for x in files]), '+': sum([x['+'] for x in files])}
+        # Only expanded files need their patch, collapsed ones are shown from the stats
+        diff = repo.commit_diff(ref)
+        diff = [num not in collapsed and diff[num] or None for num in range(len(files))]
+        return {'commit': ref, 'diff': diff, 'files': files, 'stat': stat, 'collapsed': collapsed}
 
 class PatchView(RefView):
+    content_only = True
+    max_patches = 100
+    def url_ref(self, kwargs):
+        # Ranges can name branches, so they're never immutable
+        if 'range' in request.args:
+            return None
+        return super(PatchView, self).url_ref(kwargs)
+
     def handle_request(self, repo, ref=None):
-        ref = self.lookup_ref(repo, ref)
-        # XXX port to pygit2
-        data = repo.git('format-patch', '--stdout', '%s^..%s' % (ref.hex, ref.hex)).stdout
-        return (data, 200, [{'Content-Type': 'text/plain', 'Content-Encoding': 'utf-8'}])
+        if 'range' in request.args:
+            commits = self.patch_range(repo, request.args['range'])
+        else:
+            commits = [self.lookup_ref(repo, ref)]
+        return Response(stream_with_context(self.mbox(repo, commits)), mimetype='text/plain')
+
+    def patch_range(self, repo, range):
+        """Commits in a..b, oldest first and without merges like git format-patch"""
+        if '..' not in range:
+            raise NotFound("Invalid range")
+        start, end = range.split('..', 1)
+        start, end = self.lookup_ref(repo, start), self.lookup_ref(repo, end or None)
+        walker = repo.walk(end.hex, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE)
+        walker.hide(start.hex)
+        commits = list(itertools.islice((commit for commit in walker if len(commit.parents) < 2), self.max_patches + 1))
+        if len(commits) > self.max_patches:
+            raise NotFound("Range too big, at most %d commits can be exported at once" % self.max_patches)
+        return commits
+
+    def mbox(self, repo, commits):
+        # Patches are generated and sent one at a time
+        for num, commit in enumerate(commits):
+            with open(repo.format_patch(commit)) as fd:
+                if len(commits) > 1:
+                    head = fd.read(4096)
+                    yield head.replace('Subject: [PATCH] ', 'Subject: [PATCH %d/%d] ' % (num + 1, len(commits)), 1)
+                for chunk in iter(lambda: fd.read(65536), ''):
+                    yield chunk
 
 Fakefile = namedtuple('Fakefile', ('name', 'filemode'))
 def tree_link(repo, ref, path, file):
@@ -0,0 +1,135 @@
+# Goblet - Web based git repository browser
+# Copyright (C) 2012-2014 Dennis Kaarsemaker
+# See the LICENSE file for licensing details
+
+"""Precompute cached data for a repository, so the first visitor after a push
+doesn't have to wait for it. Safe to call from a post-receive hook:
+
+  python -m goblet warm [-j jobs] <repo> [<ref>...]
+
+Without refs, the old/new/ref lines a post-receive hook gets on stdin are
+used if stdin isn't a terminal, otherwise HEAD is warmed."""
+
+import itertools
+import optparse
+import os
+import stat
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+import pygit2
+from goblet import app
+from goblet.cache import repo_cache, render_cache
+from goblet.index import TrigramIndex
+from goblet.json_views import tree_changed, tree_changed_key
+from goblet.render import render, render_key, detect_renderer, find_readme
+from goblet.snapshot import make_snapshot, snapshot_name
+
+zero = '0' * 40
+
+def open_repo(path):
+    if not os.path.exists(path) and not os.path.exists(path + '.git'):
+        path = os.path.join(app.config['REPO_ROOT'], path)
+    return pygit2.Repository(os.path.abspath(path))
+
+def resolve(repo, ref):
+    for name in (ref, 'refs/heads/' + ref, 'refs/tags/' + ref):
+        try:
+            obj = repo[repo.lookup_reference(name).target]
+            break
+        except (KeyError, ValueError):
+            pass
+    else:
+        obj = repo[ref]
+    while obj.type == pygit2.GIT_OBJ_TAG:
+        obj = repo[obj.target]
+    return obj.hex
+
+def updates(repo, refs, stdin):
+    """(old, new) commit pairs for all refs that need warming"""
+    ret = []
+    if not refs and not stdin.isatty():
+        for line in stdin:
+            old, new, ref = line.split()
+            if new != zero and (ref.startswith('refs/heads/') or ref.startswith('refs/tags/')):
+                ret.append((old != zero and old or None, resolve(repo, new)))
+    elif refs:
+        ret = [(None, resolve(repo, ref)) for ref in refs]
+    elif repo.head:
+        ret = [(None, repo.head.target.hex)]
+    return ret
+
+def tasks(repo, old, new):
+    """(artifact name, function telling whether it is cached, function) for
+       everything there is to warm for a commit"""
+    commit = repo[new]
+    never = lambda repo: False
+    yield 'changed paths %s' % new[:7], never, lambda repo: repo.changed_paths.update(new, old)
+    yield 'describe %s' % new[:7], never, lambda repo: repo.describe(new)
+    dirs = [''] + [entry.name for entry in commit.tree if stat.S_ISDIR(entry.filemode)]
+    for path in dirs:
+        key = tree_changed_key(commit, path)
+        yield ('treechanged %s:%s/' % (new[:7], path), lambda repo, key=key: repo_cache(repo).get(key),
+               lambda repo, path=path, key=key: repo_cache(repo).compute(key, lambda: tree_changed(repo, repo[new], path)))
+    readme = find_readme(commit.tree)
+    if readme:
+        yield ('render %s:%s' % (new[:7], readme.name), lambda repo: render_cache().get(render_key(readme, detect_renderer(repo, readme))),
+               lambda repo: render(repo, repo[new], readme.name, readme))
+    for format in app.config['WARM_SNAPSHOT_FORMATS']:
+        yield ('snapshot %s %s' % (new[:7], format), lambda repo, format=format: os.path.exists(snapshot_name(repo, commit, format)),
+               lambda repo, format=format: make_snapshot(repo, repo[new], format))
+
+def repo_tasks(repo):
+    """(artifact name, function telling whether it is cached, function) for
+       everything to warm once per repository"""
+    never = lambda repo: False
+    yield 'message index', never, lambda repo: repo.message_index.update()
+    if app.config['TRIGRAM_INDEX']:
+        yield 'trigram index', never, lambda repo: TrigramIndex(repo).update(app.config['TRIGRAM_INDEX_TAGS'])
+
+def run(args):
+    path, name, function = args
+    start = time.time()
+    try:
+        # Every worker uses its own handle and request context
+        with app.test_request_context():
+            function(open_repo(path))
+        result = 'done'
+    except Exception, e:
+        result = 'failed: %s' % e
+    return name, result, time.time() - start
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog warm [-j jobs] <repo> [<ref>...]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=2, help="Number of parallel workers")
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error("No repository specified")
+    # Hooks usually run as another user than the web server. With a shared
+    # group, both can then write what the other created.
+    os.umask(0002)
+    failed = False
+    with app.test_request_context():
+        repo = open_repo(args[0])
+        repo_name = repo.name
+        work, start = [], time.time()
+        todo = [tasks(repo, old, new) for old, new in updates(repo, args[1:], sys.stdin)] + [repo_tasks(repo)]
+        for name, cached, function in itertools.chain(*todo):
+            # Checking the caches can evict them and write the catalog, that
+            # mustn't stop the rest either
+            try:
+                if cached(repo):
+                    print "%-60s cached" % name
+                    continue
+            except Exception, e:
+                print "%-60s failed: %s" % (name, e)
+                failed = True
+                continue
+            work.append((repo.path, name, function))
+    pool = ThreadPool(max(1, opts.jobs))
+    for name, result, duration in pool.imap(run, work):
+        print "%-60s %s (%.2fs)" % (name, result, duration)
+        failed = failed or result != 'done'
+    pool.close()
+    print "Warmed %s in %.2fs" % (repo_name, time.time() - start)
+    return failed and 1 or 0